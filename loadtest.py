@@ -0,0 +1,487 @@
+"""
+Simulated multi-guild load test for the command layer of start.py.
+
+Drives the real commands (tocar, proximo, fila, tocar_playlist and, through the
+after-play callback, play_next) with fake ctx/guild/voice-client objects. The fake
+voice client consumes AudioSource.read() in real time (one packet every 20ms) and the
+downloader is stubbed at the FFmpeg/yt-dlp boundary, so the cache, progressive reader,
+Opus packet source, status messages and tracing all run for real.
+
+Reports event-loop lag, command latency percentiles, transition gaps, thread-pool
+saturation and memory growth.
+
+With --http-clients N it instead benchmarks the HTTP API (POST /video_info, stubbed
+extraction) with N concurrent keep-alive clients on the same event loop.
+
+Uso: python loadtest.py --guilds 50 --duration 60 --mix tocar=5,proximo=1,fila=3,tocar_playlist=1
+     python loadtest.py --http-clients 64 --duration 10
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+
+WORK_DIR = tempfile.mkdtemp(prefix="bot_loadtest_")
+os.environ.setdefault("TRACE_FILE", os.path.join(WORK_DIR, "traces", "playback.jsonl"))
+
+import aiohttp
+import discord
+
+import start
+
+FRAME_SECONDS = 0.02
+BOT_USER_ID = 1
+SILENCE_FRAME = b'\xf8\xff\xfe'
+
+
+# ============= STUBBED DOWNLOADER =============
+
+def ogg_page(packets, serial=1, pagenum=0):
+    """Build one Ogg page (CRC is not checked by discord.oggparse)"""
+    segments = b''
+    for packet in packets:
+        segments += bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    header = struct.pack('<4sBBQIIIB', b'OggS', 0, 0, 0, serial, pagenum, 0, len(segments))
+    return header + segments + b''.join(packets)
+
+def fake_track_bytes(seconds):
+    """Ogg Opus stream of silence frames lasting the given number of seconds"""
+    pages = [ogg_page([b'OpusHead' + b'\x01\x02' + b'\x00' * 9]), ogg_page([b'OpusTags' + b'\x00' * 8], pagenum=1)]
+    frames = int(seconds / FRAME_SECONDS)
+    for pagenum, first in enumerate(range(0, frames, 50), 2):
+        pages.append(ogg_page([SILENCE_FRAME] * min(50, frames - first), pagenum=pagenum))
+    return b''.join(pages)
+
+class FakeFFmpeg:
+    """Stands in for the FFmpeg child of ProgressiveDownload: writes a fake track to a pipe at a fixed rate"""
+
+    def __init__(self, data, bytes_per_second):
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self._writer = os.fdopen(write_fd, 'wb')
+        self._killed = threading.Event()
+        self._thread = threading.Thread(target=self._write, args=(data, bytes_per_second), daemon=True)
+        self._thread.start()
+
+    def _write(self, data, bytes_per_second):
+        chunk_size = 16 * 1024
+        try:
+            for offset in range(0, len(data), chunk_size):
+                if self._killed.is_set():
+                    break
+                self._writer.write(data[offset:offset + chunk_size])
+                self._writer.flush()
+                self._killed.wait(chunk_size / bytes_per_second)
+        except OSError:
+            pass
+        finally:
+            self._writer.close()
+
+    def wait(self):
+        self._thread.join()
+        return -9 if self._killed.is_set() else 0
+
+    def poll(self):
+        if self._thread.is_alive():
+            return None
+        return -9 if self._killed.is_set() else 0
+
+    def kill(self):
+        self._killed.set()
+
+def install_stubs(args):
+    """Replace network/FFmpeg calls with deterministic, timed fakes"""
+    track_data = fake_track_bytes(args.track_seconds)
+
+    def resolve_audio_stream(url, kbps=None):
+        time.sleep(random.uniform(0.5, 1.5) * args.resolve_delay)
+        return {'url': url, 'http_headers': {}, 'title': f"Faixa {start.extract_video_id(url)}"}, None
+
+    def get_video_info(url):
+        time.sleep(random.uniform(0.5, 1.5) * args.resolve_delay)
+        return {'title': f"Faixa {start.extract_video_id(url)}", 'length': args.track_seconds}, None
+
+    def progressive_start(self, stream_url, headers=None):
+        self.process = FakeFFmpeg(track_data, args.download_kbps * 1024)
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    start.resolve_audio_stream = resolve_audio_stream
+    start.get_video_info = get_video_info
+    start.ProgressiveDownload.start = progressive_start
+    start.AUDIO_CACHE_DIR = os.path.join(WORK_DIR, "cache")
+    start.PLAYLISTS_DIR = os.path.join(WORK_DIR, "playlists")
+    os.makedirs(start.AUDIO_CACHE_DIR, exist_ok=True)
+    os.makedirs(start.PLAYLISTS_DIR, exist_ok=True)
+    start.setup_tracing()
+    # The bot never logs in; on_voice_state_update compares members against bot.user
+    start.bot._connection.user = FakeMember(BOT_USER_ID, None, bot=True)
+
+# ============= FAKE DISCORD OBJECTS =============
+
+class Metrics:
+    def __init__(self):
+        self.command_latency = {}
+        self.first_audio = []
+        self.transition_gaps = []
+        self.loop_lag = []
+        self.pool_queue = []
+        self.pool_threads = []
+        self.messages_sent = 0
+        self.messages_edited = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        with self._lock:
+            getattr(self, name).append(value)
+
+    def add_latency(self, command, seconds):
+        self.command_latency.setdefault(command, []).append(seconds)
+
+metrics = Metrics()
+
+class FakeMessage:
+    async def edit(self, content=None):
+        metrics.messages_edited += 1
+        return self
+
+class FakeTextChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+class FakeVoiceClient:
+    """Consumes AudioSource.read() every 20ms on its own thread, like discord.py's AudioPlayer"""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self._connected = True
+        self._source = None
+        self._player = None
+        self._paused = threading.Event()
+        self._stop = threading.Event()
+        self._last_end = None
+        self.play_started = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_alive() and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_alive() and self._paused.is_set()
+
+    def play(self, source, *, after=None):
+        if self._player is not None and self._player.is_alive():
+            raise discord.ClientException('Already playing audio.')
+        self._stop = threading.Event()
+        self._paused.clear()
+        self._source = source
+        self.play_started = time.perf_counter()
+        self._player = threading.Thread(target=self._run, args=(source, after, self._stop), daemon=True)
+        self._player.start()
+
+    def _run(self, source, after, stop):
+        first = True
+        next_time = time.perf_counter()
+        error = None
+        try:
+            while not stop.is_set():
+                if self._paused.is_set():
+                    time.sleep(FRAME_SECONDS)
+                    next_time = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                if first:
+                    first = False
+                    now = time.perf_counter()
+                    if self.guild.command_started is not None:
+                        metrics.add('first_audio', now - self.guild.command_started)
+                        self.guild.command_started = None
+                    if self._last_end is not None:
+                        metrics.add('transition_gaps', now - self._last_end)
+                next_time += FRAME_SECONDS
+                time.sleep(max(0, next_time - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            self._last_end = time.perf_counter()
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def move_to(self, channel):
+        before, self.channel = self.channel, channel
+        before.members.remove(self.guild.me)
+        channel.members.append(self.guild.me)
+        dispatch_voice_state(self.guild.me, before, channel)
+
+    async def disconnect(self, force=False):
+        self._connected = False
+        self._last_end = None
+        self.stop()
+        self.guild.voice_client = None
+        # Like the gateway, report the bot leaving the channel afterwards
+        if self.guild.me in self.channel.members:
+            self.channel.members.remove(self.guild.me)
+            dispatch_voice_state(self.guild.me, self.channel, None)
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+        self.bitrate = random.choice((64000, 96000, 128000))  # Unboosted to boosted servers
+        self.members = []
+
+    async def connect(self):
+        await asyncio.sleep(random.uniform(0.2, 0.6))  # Voice handshake
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        self.members.append(self.guild.me)
+        dispatch_voice_state(self.guild.me, None, self)
+        return self.guild.voice_client
+
+class FakeMember:
+    def __init__(self, member_id, guild, bot=False):
+        self.id = member_id
+        self.guild = guild
+        self.bot = bot
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+def dispatch_voice_state(member, before, after):
+    """Schedule on_voice_state_update for a member moving from channel before to after"""
+    start.spawn(start.on_voice_state_update(member, FakeVoiceState(before), FakeVoiceState(after)))
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_client = None
+        self.me = FakeMember(BOT_USER_ID, self, bot=True)
+        self.voice_channel = FakeVoiceChannel(self, guild_id * 10)
+        self.command_started = None
+
+class FakeAuthor:
+    def __init__(self, guild):
+        self.voice = FakeVoiceState(guild.voice_channel)
+
+class FakeContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.author = FakeAuthor(guild)
+        self.channel = FakeTextChannel(guild.id * 10 + 1)
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        metrics.messages_sent += 1
+        return FakeMessage()
+
+# ============= DRIVER =============
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'tocar', 'proximo', 'fila', 'tocar_playlist'}
+    if unknown:
+        raise SystemExit(f"Comandos desconhecidos no --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+def random_url(catalog):
+    return f"https://www.youtube.com/watch?v=vid{random.randrange(catalog):08d}"
+
+async def run_command(name, ctx, args):
+    guild = ctx.guild
+    started = time.perf_counter()
+    try:
+        if name == 'tocar':
+            if guild.voice_client is None or not (guild.voice_client.is_playing() or guild.voice_client.is_paused()):
+                guild.command_started = started
+            await start.tocar(ctx, random_url(args.catalog))
+        elif name == 'tocar_playlist':
+            if guild.voice_client is None or not (guild.voice_client.is_playing() or guild.voice_client.is_paused()):
+                guild.command_started = started
+            await start.tocar_playlist_cmd(ctx, playlist_name="loadtest")
+        elif name == 'proximo':
+            await start.proximo(ctx)
+        elif name == 'fila':
+            await start.fila(ctx)
+    except Exception as e:
+        metrics.errors.append(f"{name}: {type(e).__name__}: {e}")
+    metrics.add_latency(name, time.perf_counter() - started)
+
+async def guild_worker(guild_id, args, mix, deadline):
+    ctx = FakeContext(FakeGuild(guild_id))
+    names, weights = list(mix), list(mix.values())
+    await asyncio.sleep(random.uniform(0, args.think))
+    while time.perf_counter() < deadline:
+        await run_command(random.choices(names, weights)[0], ctx, args)
+        await asyncio.sleep(random.expovariate(1 / args.think))
+    if ctx.voice_client is not None:
+        await start.parar(ctx)
+
+async def lag_probe(interval, deadline):
+    while time.perf_counter() < deadline:
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.add('loop_lag', time.perf_counter() - before - interval)
+
+async def pool_probe(executor, deadline):
+    while time.perf_counter() < deadline:
+        metrics.pool_queue.append(executor._work_queue.qsize())
+        metrics.pool_threads.append(len(executor._threads))
+        await asyncio.sleep(0.1)
+
+def write_playlist(args):
+    songs = [{"url": random_url(args.catalog), "title": f"Faixa {i}"} for i in range(args.playlist_size)]
+    with open(start.get_playlist_path("loadtest"), 'w', encoding='utf-8') as f:
+        json.dump({"name": "loadtest", "songs": songs}, f)
+
+def describe(values, scale=1000.0, unit="ms"):
+    if not values:
+        return "sem amostras"
+    scaled = [value * scale for value in values]
+    return (
+        f"n={len(scaled)} p50={start.percentile(scaled, 50):.1f}{unit} "
+        f"p95={start.percentile(scaled, 95):.1f}{unit} p99={start.percentile(scaled, 99):.1f}{unit} "
+        f"max={max(scaled):.1f}{unit}"
+    )
+
+async def http_benchmark(args):
+    """Concurrent keep-alive clients against POST /video_info served by start.app"""
+    install_stubs(args)
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+    loop.set_default_executor(executor)
+    start.HTTP_HOST, start.HTTP_PORT = "127.0.0.1", args.http_port
+    runner = await start.start_http_server()
+
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + args.duration
+    endpoint = f"http://127.0.0.1:{args.http_port}/video_info"
+
+    async def client(session):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                async with session.post(endpoint, json={'url': random_url(args.catalog)}) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    lag = asyncio.create_task(lag_probe(0.05, deadline))
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.http_clients)) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.http_clients)))
+    await lag
+    await runner.cleanup()
+    executor.shutdown(wait=False)
+
+    print(f"\n===== HTTP: {args.http_clients} clientes, {args.duration:.0f}s, {args.workers} workers =====")
+    print(f"Throughput:               {len(latencies) / args.duration:.0f} req/s ({errors} erro(s))")
+    print(f"Latência /video_info:     {describe(latencies)}")
+    print(f"Lag do event loop:        {describe(metrics.loop_lag)}")
+
+async def main(args):
+    mix = parse_mix(args.mix)
+    install_stubs(args)
+    write_playlist(args)
+
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+    loop.set_default_executor(executor)
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    deadline = time.perf_counter() + args.duration
+
+    probes = [asyncio.create_task(lag_probe(0.05, deadline)), asyncio.create_task(pool_probe(executor, deadline))]
+    await asyncio.gather(*(guild_worker(guild_id, args, mix, deadline) for guild_id in range(1, args.guilds + 1)))
+    await asyncio.gather(*probes)
+    # Let the last stop/transition callbacks settle
+    await asyncio.sleep(1)
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"\n===== Load test: {args.guilds} servidores, {args.duration:.0f}s, mix {args.mix} =====")
+    print(f"Lag do event loop:        {describe(metrics.loop_lag)}")
+    for name, values in sorted(metrics.command_latency.items()):
+        print(f"Latência !{name:<15} {describe(values)}")
+    print(f"Tempo até o 1º áudio:     {describe(metrics.first_audio)}")
+    print(f"Gap entre músicas:        {describe(metrics.transition_gaps)}")
+    if metrics.pool_queue:
+        print(
+            f"Thread pool ({args.workers} workers): fila média {sum(metrics.pool_queue) / len(metrics.pool_queue):.1f}, "
+            f"fila máx {max(metrics.pool_queue)}, threads máx {max(metrics.pool_threads)}"
+        )
+    print(
+        f"Memória (tracemalloc):    antes {memory_before / 1024:.0f} KB, depois {memory_after / 1024:.0f} KB, "
+        f"pico {memory_peak / 1024:.0f} KB, crescimento {(memory_after - memory_before) / 1024:.0f} KB"
+    )
+    print(
+        f"Mensagens Discord:        {metrics.messages_sent} envios, {metrics.messages_edited} edições, "
+        f"{start.outbound.dropped} descartadas, {start.outbound.merged} mescladas"
+    )
+    print(f"Estado em memória:        {len(start.music_queues)} servidor(es), {len(start.progressive_downloads)} download(s)")
+    print(
+        f"Conexões de voz:          {start.voice_stats['cold_connects']} novas, "
+        f"{start.voice_stats['warm_reuses']} reutilizadas (idle grace {start.VOICE_IDLE_GRACE:.0f}s)"
+    )
+    if metrics.errors:
+        print(f"Erros ({len(metrics.errors)}):")
+        for error in metrics.errors[:10]:
+            print(f"  - {error}")
+
+    executor.shutdown(wait=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test simulado de vários servidores para os comandos do bot")
+    parser.add_argument('--guilds', type=int, default=20, help="Servidores simulados em paralelo")
+    parser.add_argument('--duration', type=float, default=30, help="Duração do teste em segundos")
+    parser.add_argument('--mix', default="tocar=5,proximo=1,fila=3,tocar_playlist=1", help="Pesos dos comandos")
+    parser.add_argument('--think', type=float, default=3, help="Intervalo médio entre comandos de um servidor (s)")
+    parser.add_argument('--track-seconds', type=float, default=8, help="Duração de cada música falsa")
+    parser.add_argument('--resolve-delay', type=float, default=0.8, help="Tempo médio de extração do yt-dlp (s)")
+    parser.add_argument('--download-kbps', type=float, default=512, help="Velocidade do download falso (KB/s)")
+    parser.add_argument('--catalog', type=int, default=200, help="Quantidade de vídeos distintos")
+    parser.add_argument('--playlist-size', type=int, default=5, help="Músicas na playlist de teste")
+    parser.add_argument('--workers', type=int, default=min(32, (os.cpu_count() or 1) + 4), help="Threads do executor")
+    parser.add_argument('--http-clients', type=int, default=0, help="Benchmark da API HTTP com N clientes")
+    parser.add_argument('--http-port', type=int, default=5099)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(http_benchmark(args) if args.http_clients else main(args))
@@ -1,33 +1,90 @@
-from flask import Flask, request, jsonify
+from aiohttp import web
 import yt_dlp
 import re
 import json
 
 import asyncio
+import concurrent.futures
 import os
 import subprocess
 import threading
 import tempfile
 import base64
 import shutil
+import math
+import logging
+import logging.handlers
+import contextlib
+try:
+    import resource  # Unix only, used by !memoria
+except ImportError:
+    resource = None
+import sys
+import mmap
+import glob
+import hashlib
+import time
+import queue
+from collections import OrderedDict
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+from discord.oggparse import OggStream, OggError
+from discord.opus import OPUS_SILENCE
 
-app = Flask(__name__)
+# HTTP API, served by aiohttp on the bot's own event loop
+app = web.Application()
+routes = web.RouteTableDef()
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOWNLOAD_DIR = os.path.join(BASE_DIR, "downloads")
 PLAYLISTS_DIR = os.path.join(BASE_DIR, "playlists")
 _local_ffmpeg = os.path.join(BASE_DIR, "ffmpeg", "bin", "ffmpeg.exe")
 FFMPEG_PATH = os.getenv("FFMPEG_PATH") or (_local_ffmpeg if os.path.exists(_local_ffmpeg) else "ffmpeg")
-MAX_MP3_BYTES = 100 * 1024 * 1024
+# Default admission limits, checked before downloading (guilds can tighten them, see LIMITS_FILE)
+MAX_DOWNLOAD_MB = float(os.getenv("MAX_DOWNLOAD_MB", "100"))  # Per download (MP3 or cached Opus)
+MAX_VIDEO_MINUTES = float(os.getenv("MAX_VIDEO_MINUTES", "180"))
+ALLOW_LIVE = os.getenv("ALLOW_LIVE", "0") == "1"  # Live streams never end, so they are refused by default
+LIMITS_FILE = os.getenv("LIMITS_FILE", os.path.join(BASE_DIR, "limits.json"))  # Per-guild and per-API-client limits
 MP3_BITRATE = "192k"
 MP3_SAMPLE_RATE = "44100"
 MP3_CHANNELS = "2"
-
-# Ensure playlists directory exists
+# Local audio cache, filled progressively while the first play is already running
+AUDIO_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "1024")) * 1024 * 1024
+PINNED_CACHE_MAX_BYTES = int(os.getenv("PINNED_CACHE_MAX_MB", "512")) * 1024 * 1024  # Part of the cache pinned playlists may hold
+PROGRESSIVE_PREBUFFER_SECONDS = float(os.getenv("PROGRESSIVE_PREBUFFER_SECONDS", "3"))
+PROGRESSIVE_STALL_TIMEOUT = float(os.getenv("PROGRESSIVE_STALL_TIMEOUT", "60"))  # Max seconds the player waits for new data
+# Cached tracks are stored as 48kHz Ogg Opus (20ms frames) and sent to Discord without re-encoding,
+# encoded at the smallest tier (kbps) that covers the voice channel's bitrate
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "96k")  # Used when the voice channel is unknown (e.g. playlist materialization)
+OPUS_BITRATE_TIERS = sorted(int(kbps) for kbps in os.getenv("OPUS_BITRATE_TIERS", "64,96,128").split(','))
+OPUS_SAMPLE_RATE = "48000"
+# Outbound Discord messages: per-route bucket (requests per window) and backlog limit
+OUTBOUND_ROUTE_BURST = int(os.getenv("OUTBOUND_ROUTE_BURST", "5"))
+OUTBOUND_ROUTE_WINDOW = float(os.getenv("OUTBOUND_ROUTE_WINDOW", "5"))
+OUTBOUND_MAX_PENDING = int(os.getenv("OUTBOUND_MAX_PENDING", "50"))
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "1.5"))  # Min seconds between edits of a status message
+# Time-to-first-audio traces (rotating JSONL file, read back by !stats)
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(BASE_DIR, "traces", "playback.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_MB", "5")) * 1024 * 1024
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "3"))
+TRACE_WINDOW_MINUTES = float(os.getenv("TRACE_WINDOW_MINUTES", "60"))
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "5000"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "75"))
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "32"))  # Shared pool for yt-dlp/file work (bot + HTTP API)
+VIDEO_INFO_TTL = float(os.getenv("VIDEO_INFO_TTL", "600"))  # Seconds a video's metadata stays cached
+VOICE_IDLE_GRACE = float(os.getenv("VOICE_IDLE_GRACE", "120"))  # Seconds an idle voice connection is kept warm (0 = leave at once)
+GUILD_IDLE_TTL = float(os.getenv("GUILD_IDLE_TTL", "1800"))  # Seconds before an idle guild's queue state is evicted
+MATERIALIZE_PARALLELISM = int(os.getenv("MATERIALIZE_PARALLELISM", "2"))  # Concurrent downloads when caching a playlist
+IMPORT_PARALLELISM = int(os.getenv("IMPORT_PARALLELISM", "4"))  # Concurrent title lookups in a bulk playlist import
+IMPORT_MAX_ITEMS = int(os.getenv("IMPORT_MAX_ITEMS", "500"))  # Videos accepted by one bulk import
+MATERIALIZE_INTERVAL_MINUTES = float(os.getenv("MATERIALIZE_INTERVAL_MINUTES", "360"))  # Re-cache pinned playlists (0 = disabled)
+
+# Ensure playlists and audio cache directories exist
 os.makedirs(PLAYLISTS_DIR, exist_ok=True)
+os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 YT_COOKIES_FILE = os.getenv("YT_COOKIES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookies.txt"))  # Path to cookies.txt file
@@ -186,14 +243,61 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Queue system: {guild_id: {'current': path, 'queue': [(url, title), ...]}}
+class Track:
+    """Compact queue entry: video ID plus an interned title shared by every queue holding it"""
+    __slots__ = ('video_id', 'title')
+
+    def __init__(self, url, title=None):
+        self.video_id = extract_video_id(url)
+        self.title = sys.intern(title or 'Sem título')
+
+    @property
+    def url(self):
+        return f"https://www.youtube.com/watch?v={self.video_id}"
+
+# Queue system: {guild_id: {'current': path, 'queue': [Track, ...], 'downloads': {ProgressiveDownload}, 'generation': int, 'last_used': float, 'idle_task': Task, 'preparing': int}}
 music_queues = {}
 
 def get_queue(guild_id):
     """Get or initialize queue for a guild"""
     if guild_id not in music_queues:
-        music_queues[guild_id] = {'current': None, 'queue': []}
-    return music_queues[guild_id]
+        music_queues[guild_id] = {'current': None, 'queue': [], 'downloads': set(), 'generation': 0, 'last_used': 0.0, 'idle_task': None, 'preparing': 0}
+    queue_data = music_queues[guild_id]
+    queue_data['last_used'] = time.monotonic()
+    return queue_data
+
+def evict_idle_guilds():
+    """Drop the state of guilds idle for GUILD_IDLE_TTL (not in a voice channel, nothing downloading)"""
+    now = time.monotonic()
+    evicted = 0
+    for guild_id, queue_data in list(music_queues.items()):
+        if now - queue_data['last_used'] < GUILD_IDLE_TTL:
+            continue
+        guild = bot.get_guild(guild_id)
+        if guild is not None and guild.voice_client is not None:
+            continue
+        if queue_data['preparing'] or any(not download.done for download in queue_data['downloads']):
+            continue
+        release_current(queue_data)
+        del music_queues[guild_id]
+        evicted += 1
+    return evicted
+
+def estimate_queue_footprint(queue_data, seen=None):
+    """
+    Approximate bytes held by a guild's queue state.
+    Objects already in seen (ids) are not counted again, so shared titles count once in totals.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    objects = [queue_data, queue_data['queue'], queue_data['downloads'], queue_data['current']]
+    for track in queue_data['queue']:
+        objects += [track, track.video_id, track.title]
+    for obj in objects:
+        if obj is not None and id(obj) not in seen:
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+    return size
 
 def cleanup_file(file_path):
     """Safely delete a music file"""
@@ -204,6 +308,296 @@ def cleanup_file(file_path):
         except OSError as e:
             print(f"[DEBUG] ⚠️ Erro ao remover arquivo: {e}")
 
+# ============= OUTBOUND MESSAGES =============
+
+# Strong references to fire-and-forget tasks (asyncio only keeps weak ones)
+_background_tasks = set()
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+class OutboundScheduler:
+    """
+    Global scheduler for messages sent to Discord.
+    Each route (channel) has a token bucket of OUTBOUND_ROUTE_BURST requests per
+    OUTBOUND_ROUTE_WINDOW seconds, drained by a single task per route. Jobs with
+    the same key are merged, and non-essential jobs are dropped when the
+    backlog reaches OUTBOUND_MAX_PENDING.
+    """
+
+    def __init__(self, burst, window, max_pending):
+        self.burst = burst
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+        self.merged = 0
+        self._routes = {}
+
+    def submit(self, route, factory, key=None, essential=True):
+        """
+        Schedule factory() (a coroutine function) on the route.
+        Returns a future with the result, or None if the job failed or was dropped.
+        """
+        loop = asyncio.get_running_loop()
+        state = self._routes.get(route)
+        if state is None:
+            state = self._routes[route] = {
+                'jobs': OrderedDict(),
+                'tokens': float(self.burst),
+                'updated': loop.time(),
+                'task': None,
+            }
+
+        if key is not None and key in state['jobs']:
+            job = state['jobs'][key]
+            job['factory'] = factory
+            job['essential'] = job['essential'] or essential
+            self.merged += 1
+            return job['future']
+
+        future = loop.create_future()
+        if not essential and self.pending >= self.max_pending:
+            self.dropped += 1
+            future.set_result(None)
+            return future
+
+        state['jobs'][key if key is not None else object()] = {
+            'factory': factory,
+            'essential': essential,
+            'future': future,
+        }
+        self.pending += 1
+        if state['task'] is None:
+            state['task'] = spawn(self._drain(route, state))
+        return future
+
+    async def _drain(self, route, state):
+        loop = asyncio.get_running_loop()
+        rate = self.burst / self.window
+        try:
+            while state['jobs']:
+                now = loop.time()
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * rate)
+                state['updated'] = now
+                if state['tokens'] < 1:
+                    await asyncio.sleep((1 - state['tokens']) / rate)
+                    continue
+
+                _, job = state['jobs'].popitem(last=False)
+                self.pending -= 1
+                if not job['essential'] and self.pending >= self.max_pending:
+                    self.dropped += 1
+                    if not job['future'].done():
+                        job['future'].set_result(None)
+                    continue
+
+                state['tokens'] -= 1
+                result = None
+                try:
+                    result = await job['factory']()
+                except Exception as e:
+                    print(f"[DEBUG] ⚠️ Erro ao enviar mensagem: {type(e).__name__}: {e}")
+                if not job['future'].done():
+                    job['future'].set_result(result)
+        finally:
+            state['task'] = None
+            # Forget the route once its bucket has had time to refill
+            loop.call_later(self.window, self._forget, route)
+
+    def _forget(self, route):
+        state = self._routes.get(route)
+        if state is not None and state['task'] is None and not state['jobs']:
+            del self._routes[route]
+
+outbound = OutboundScheduler(OUTBOUND_ROUTE_BURST, OUTBOUND_ROUTE_WINDOW, OUTBOUND_MAX_PENDING)
+
+async def reply(ctx, content, essential=True):
+    """Send a message through the outbound scheduler"""
+    return await outbound.submit(ctx.channel.id, lambda: ctx.send(content), essential=essential)
+
+class StatusMessage:
+    """
+    Single status message per command: sent once, then edited in place.
+    update() returns immediately; edits are throttled to STATUS_EDIT_INTERVAL
+    and intermediate contents are merged, so only the latest one is sent.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.message = None
+        self.content = None
+        self._sent = None
+        self._essential = False
+        self._last_edit = 0.0
+        self._task = None
+
+    def update(self, content, essential=False):
+        self.content = content
+        self._essential = self._essential or essential
+        if self._task is None:
+            self._task = spawn(self._flush())
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        route = self.ctx.channel.id
+        try:
+            while self.content != self._sent:
+                if self.message is None:
+                    self._sent = self.content
+                    self.message = await outbound.submit(route, lambda: self.ctx.send(self._sent))
+                    if self.message is None:
+                        return
+                    self._last_edit = loop.time()
+                    continue
+
+                delay = self._last_edit + STATUS_EDIT_INTERVAL - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                essential, self._essential = self._essential, False
+                attempted = False
+
+                async def edit():
+                    nonlocal attempted
+                    attempted = True
+                    self._sent = self.content
+                    return await self.message.edit(content=self._sent)
+
+                await outbound.submit(route, edit, key=('status', id(self)), essential=essential)
+                self._last_edit = loop.time()
+                # Dropped under pressure: keep what is shown until the next update
+                if not attempted:
+                    return
+        finally:
+            self._task = None
+
+# ============= END OUTBOUND MESSAGES =============
+
+# ============= PLAYBACK TRACING =============
+
+TRACE_PHASES = ['voice_connect', 'metadata', 'executor_wait', 'download', 'ffmpeg_spawn', 'first_packet']
+
+trace_logger = logging.getLogger("playback_trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+
+def setup_tracing():
+    """Open TRACE_FILE for writing (once); until then traces are dropped, so importing start creates no files"""
+    if trace_logger.handlers:
+        return
+    os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, encoding='utf-8'
+    )
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+
+class PlaybackTrace:
+    """
+    Spans of one playback command (or play_next transition), from the command until the
+    first audio packet. Written as one JSON line when finished.
+    """
+
+    def __init__(self, command, guild_id):
+        self.command = command
+        self.guild_id = guild_id
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.finished = False
+
+    def add(self, phase, seconds):
+        self.spans[phase] = self.spans.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def finish(self, outcome):
+        """Record the trace; outcome is 'played', 'queued', 'cancelled' or 'error'"""
+        if self.finished:
+            return
+        self.finished = True
+        record = {
+            'ts': time.time(),
+            'command': self.command,
+            'guild': self.guild_id,
+            'outcome': outcome,
+            'total': round(time.perf_counter() - self.started, 4),
+            'spans': {phase: round(seconds, 4) for phase, seconds in self.spans.items()},
+        }
+        trace_logger.info(json.dumps(record))
+
+async def run_traced(trace, phase, func, *args):
+    """run_in_executor, recording time spent queued in the pool (executor_wait) and running (phase)"""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+    started = None
+
+    def call():
+        nonlocal started
+        started = time.perf_counter()
+        return func(*args)
+
+    try:
+        return await loop.run_in_executor(None, call)
+    finally:
+        if trace is not None and started is not None:
+            trace.add('executor_wait', started - submitted)
+            trace.add(phase, time.perf_counter() - started)
+
+class FirstPacketProbe(discord.AudioSource):
+    """Wraps an audio source and calls on_first_packet when the voice client reads its first packet"""
+
+    def __init__(self, source, on_first_packet):
+        self.source = source
+        self._on_first_packet = on_first_packet
+
+    def read(self):
+        data = self.source.read()
+        if data and self._on_first_packet is not None:
+            callback, self._on_first_packet = self._on_first_packet, None
+            callback()
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+def load_trace_records(since):
+    """Read trace records newer than since (epoch seconds) from the current and rotated files"""
+    records = []
+    paths = [TRACE_FILE] + [f"{TRACE_FILE}.{i}" for i in range(1, TRACE_BACKUP_COUNT + 1)]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('ts', 0) >= since:
+                    records.append(record)
+    return records
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+# ============= END PLAYBACK TRACING =============
+
 # ============= PLAYLIST MANAGEMENT =============
 
 def get_playlist_path(playlist_name):
@@ -257,6 +651,39 @@ def adicionar_a_playlist(playlist_name, url, title=None):
     except Exception as e:
         return False, f"Erro ao adicionar música: {str(e)}"
 
+def adicionar_varias_a_playlist(playlist_name, songs):
+    """
+    Add many songs to a playlist in a single write, skipping videos (by ID) already in it.
+    Returns (added, error) where added lists the songs actually added.
+    """
+    playlist_path = get_playlist_path(playlist_name)
+    
+    if not os.path.exists(playlist_path):
+        return None, "Playlist não encontrada"
+    
+    try:
+        with open(playlist_path, 'r', encoding='utf-8') as f:
+            playlist_data = json.load(f)
+        
+        known = {extract_video_id(song['url']) for song in playlist_data['songs']}
+        added = []
+        for song in songs:
+            video_id = extract_video_id(song['url'])
+            if video_id in known:
+                continue
+            known.add(video_id)
+            entry = {"url": song['url'], "title": song.get('title') or "Sem título"}
+            playlist_data['songs'].append(entry)
+            added.append(entry)
+        
+        if added:
+            with open(playlist_path, 'w', encoding='utf-8') as f:
+                json.dump(playlist_data, f, indent=2, ensure_ascii=False)
+        
+        return added, None
+    except Exception as e:
+        return None, f"Erro ao adicionar músicas: {str(e)}"
+
 def carregar_playlist(playlist_name):
     """Load a playlist and return its songs"""
     playlist_path = get_playlist_path(playlist_name)
@@ -295,52 +722,226 @@ def listar_playlists():
                     data = json.load(f)
                     playlists.append({
                         'name': data['name'],
-                        'count': len(data['songs'])
+                        'count': len(data['songs']),
+                        'pinned': data.get('pinned', False)
                     })
         return playlists, None
     except Exception as e:
         return None, f"Erro ao listar playlists: {str(e)}"
 
+def fixar_playlist(playlist_name, pinned=True):
+    """Pin (or unpin) a playlist; songs of pinned playlists are kept in the audio cache (up to PINNED_CACHE_MAX_BYTES)"""
+    playlist_path = get_playlist_path(playlist_name)
+    
+    if not os.path.exists(playlist_path):
+        return False, "Playlist não encontrada"
+    
+    try:
+        with open(playlist_path, 'r', encoding='utf-8') as f:
+            playlist_data = json.load(f)
+        
+        playlist_data['pinned'] = pinned
+        
+        with open(playlist_path, 'w', encoding='utf-8') as f:
+            json.dump(playlist_data, f, indent=2, ensure_ascii=False)
+        
+        return True, "Playlist fixada no cache" if pinned else "Playlist removida do cache fixo"
+    except Exception as e:
+        return False, f"Erro ao atualizar playlist: {str(e)}"
+
+def pinned_video_ids():
+    """Video IDs of every song in a pinned playlist"""
+    video_ids = set()
+    for filename in os.listdir(PLAYLISTS_DIR):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PLAYLISTS_DIR, filename), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if data.get('pinned'):
+            video_ids.update(extract_video_id(song['url']) for song in data['songs'])
+    return video_ids
+
 # ============= END PLAYLIST MANAGEMENT =============
 
-@app.route('/download_mp3', methods=['POST'])
-def download_audio():
-    data = request.get_json()
+# ============= ADMISSION LIMITS =============
+# LIMITS_FILE: {"guilds": {"<guild id>": {...}}, "clients": {"<X-Client-Id>": {...}}}
+# with any of max_minutes, max_mb and allow_live. Guild limits (set with !definir_limites) and
+# API client limits (set by the operator) can only tighten the global ones: X-Client-Id is not
+# authenticated, so a client ID must never unlock anything.
+
+_limits_config = None
+
+def load_limits_config():
+    """Limits file contents, read once and kept in memory"""
+    global _limits_config
+    if _limits_config is None:
+        try:
+            with open(LIMITS_FILE, 'r', encoding='utf-8') as f:
+                _limits_config = json.load(f)
+        except FileNotFoundError:
+            _limits_config = {}
+        except (OSError, ValueError) as e:
+            print(f"[DEBUG] ⚠️ Erro ao ler {LIMITS_FILE}: {e}")
+            _limits_config = {}
+        _limits_config.setdefault('guilds', {})
+        _limits_config.setdefault('clients', {})
+    return _limits_config
+
+def get_limits(guild_id=None, client_id=None):
+    """Effective admission limits for a guild or an API client"""
+    limits = {'max_minutes': MAX_VIDEO_MINUTES, 'max_mb': MAX_DOWNLOAD_MB, 'allow_live': ALLOW_LIVE}
+    config = load_limits_config()
+    overrides = {}
+    if guild_id is not None:
+        overrides = config['guilds'].get(str(guild_id), {})
+    elif client_id is not None:
+        overrides = config['clients'].get(client_id, {})
+    for key, value in overrides.items():
+        if key == 'allow_live':
+            limits[key] = limits[key] and bool(value)
+        elif key in limits:
+            limits[key] = min(limits[key], value)
+    return limits
+
+def set_guild_limits(guild_id, max_minutes, max_mb, allow_live):
+    """Save a guild's limits to LIMITS_FILE"""
+    config = load_limits_config()
+    config['guilds'][str(guild_id)] = {'max_minutes': max_minutes, 'max_mb': max_mb, 'allow_live': allow_live}
+    try:
+        with open(LIMITS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        return True, None
+    except OSError as e:
+        return False, f"Erro ao salvar limites: {str(e)}"
+
+def admission_fields(info):
+    """The parts of a yt-dlp info dict check_admission looks at"""
+    return {key: info.get(key) for key in ('duration', 'is_live', 'live_status', 'filesize', 'filesize_approx')}
+
+def check_admission(info, limits):
+    """Why a video must not be downloaded (from its yt-dlp info dict), or None if it may"""
+    if (info.get('is_live') or info.get('live_status') in ('is_live', 'is_upcoming')) and not limits['allow_live']:
+        return "Transmissões ao vivo não são permitidas"
+    duration = info.get('duration')
+    if duration and duration > limits['max_minutes'] * 60:
+        return f"Vídeo muito longo ({duration / 60:.0f} min, limite {limits['max_minutes']:g} min)"
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size and size > limits['max_mb'] * 1024 * 1024:
+        return f"Arquivo muito grande ({size / 1024 / 1024:.0f}MB, limite {limits['max_mb']:g}MB)"
+    return None
+
+# ============= END ADMISSION LIMITS =============
+
+async def read_json(request):
+    """Request body as a dict (empty if missing or invalid)"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+@routes.post('/download_mp3')
+async def download_audio(request):
+    data = await read_json(request)
     url = data.get('url')
 
     if not url:
-        return jsonify({"error": "Parâmetro 'url' ausente."}), 400
+        return web.json_response({"error": "Parâmetro 'url' ausente."}, status=400)
 
     if not is_valid_youtube_url(url):
-        return jsonify({"error": "URL do YouTube inválida."}), 400
+        return web.json_response({"error": "URL do YouTube inválida."}, status=400)
 
-    success, mp3_path, error = download_mp3(url)
+    limits = get_limits(client_id=request.headers.get('X-Client-Id'))
+
+    # If the client goes away, the handler is cancelled and so is the download
+    cancel_event = threading.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        success, mp3_path, error = await loop.run_in_executor(None, download_mp3, url, cancel_event, limits)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+    except DownloadRefused as e:
+        return web.json_response({"error": e.msg}, status=e.status)
 
     if success:
-        return jsonify({"message": "MP3 baixado com sucesso."}), 200
+        return web.json_response({"message": "MP3 baixado com sucesso."}, status=200)
     else:
-        return jsonify({"error": error}), 500
+        return web.json_response({"error": error}, status=500)
+
+def get_download_strategies(kbps=None):
+    """
+    List of strategies to try (cookie-only for local testing).
+    With kbps, audio formats are ranked by ascending bitrate so "best" is the smallest one
+    covering kbps (or the highest available if none does).
+    """
+    audio = {"format": "bestaudio[ext=m4a]/bestaudio/best"}
+    if kbps:
+        audio = {"format": f"bestaudio[abr>={kbps}]/worstaudio/worst", "format_sort": ["+abr"]}
+    strategies = [
+        {"name": "Com cookies (audio)", "cookies": True, **audio},
+        {"name": "Com cookies (fallback)", "cookies": True, "format": "worstaudio/worst"},
+        {"name": "Com PO Token (se disponível)", "cookies": True, **audio} if YT_PO_TOKEN else None,
+    ]
+    return [s for s in strategies if s is not None]  # Remove None entries
+
+class DownloadCancelled(yt_dlp.utils.DownloadCancelled):
+    """Raised when a download is cancelled by !parar, !proximo or a voice disconnect"""
+    msg = 'Download cancelado'
+
+class DownloadRefused(DownloadCancelled):
+    """Raised when a video is outside the admission limits (a client error, not a failure)"""
+    status = 422
+
+    def __init__(self, msg):
+        self.msg = msg
+        super().__init__(msg)
+
+class DownloadTooLarge(DownloadRefused):
+    """Raised mid-download as soon as more bytes than the size limit arrive"""
+    status = 413
+
+    def __init__(self, max_mb):
+        super().__init__(f"Download excede o limite de {max_mb:g}MB")
+
+def cleanup_partial_downloads(base_path):
+    """Remove every file yt-dlp may have left for an output template (.part, .m4a, .webm...)"""
+    for path in glob.glob(glob.escape(base_path) + '*'):
+        cleanup_file(path)
+
+def download_mp3(url, cancel_event=None, limits=None):
+    """
+    Download and convert to MP3. If cancel_event (threading.Event) gets set, the
+    yt-dlp progress/postprocessor hooks abort the download and partial files are removed.
+    Videos outside limits (see get_limits) are refused before downloading, and the
+    download is aborted as soon as it grows past limits['max_mb']: both raise DownloadRefused.
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    limits = limits or get_limits()
+    max_bytes = limits['max_mb'] * 1024 * 1024
+
+    # Generate unique filename
+    mp3_file = os.path.join(DOWNLOAD_DIR, f"{os.urandom(8).hex()}.mp3")
+
+    def check_cancelled(_):
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled()
+
+    def check_progress(progress):
+        check_cancelled(progress)
+        if (progress.get('downloaded_bytes') or 0) > max_bytes:
+            raise DownloadTooLarge(limits['max_mb'])
 
-def download_mp3(url):
     try:
-        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-        
-        # Generate unique filename
-        mp3_file = os.path.join(DOWNLOAD_DIR, f"{os.urandom(8).hex()}.mp3")
-        
         print(f"\n[DEBUG] ========== INICIANDO DOWNLOAD ==========")
         print(f"[DEBUG] URL: {url}")
         print(f"[DEBUG] Plataforma: {os.name}")
         
-        # List of strategies to try (cookie-only for local testing)
-        strategies = [
-            {"name": "Com cookies (audio)", "cookies": True, "format": "bestaudio[ext=m4a]/bestaudio/best"},
-            {"name": "Com cookies (fallback)", "cookies": True, "format": "worstaudio/worst"},
-            {"name": "Com PO Token (se disponível)", "cookies": True, "format": "bestaudio[ext=m4a]/bestaudio/best"} if YT_PO_TOKEN else None,
-        ]
-        strategies = [s for s in strategies if s is not None]  # Remove None entries
-        
-        for idx, strategy in enumerate(strategies, 1):
+        for idx, strategy in enumerate(get_download_strategies(), 1):
+            check_cancelled(None)
             try:
                 print(f"\n[DEBUG] ===== Tentativa {idx}: {strategy['name']} =====")
                 
@@ -376,6 +977,8 @@ def download_mp3(url):
                     }],
                     'postprocessor_args': ['-threads', '2'],
                     'outtmpl': mp3_file.replace('.mp3', ''),
+                    'progress_hooks': [check_progress],
+                    'postprocessor_hooks': [check_cancelled],
                     'ffmpeg_location': os.path.dirname(FFMPEG_PATH) if os.path.dirname(FFMPEG_PATH) else None,
                 })
                 
@@ -383,22 +986,37 @@ def download_mp3(url):
                 print(f"[DEBUG] Format: {strategy['format']}")
                 
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
+                    # Look at duration/size/live status before a single media byte is fetched
+                    info = ydl.extract_info(url, download=False)
+                    rejected = check_admission(info, limits)
+                    if rejected:
+                        raise DownloadRefused(rejected)
+                    ydl.process_ie_result(info, download=True)
                 
                 if os.path.exists(mp3_file):
                     file_size = os.path.getsize(mp3_file)
                     print(f"[DEBUG] ✅ {strategy['name']}: Sucesso! Tamanho: {file_size} bytes")
-                    if file_size > MAX_MP3_BYTES:
-                        os.remove(mp3_file)
-                        return False, None, "MP3 excede o limite de 100MB."
+                    if file_size > max_bytes:
+                        raise DownloadTooLarge(limits['max_mb'])
                     return True, mp3_file, None
+            except DownloadCancelled:
+                raise
             except Exception as e:
                 print(f"[DEBUG] ❌ {strategy['name']}: {type(e).__name__}: {str(e)[:100]}")
+                cleanup_partial_downloads(mp3_file.replace('.mp3', ''))
                 continue
         
         print(f"\n[DEBUG] ========== TODAS AS ESTRATÉGIAS FALHARAM ==========\n")
         return False, None, "Não foi possível fazer download do vídeo - YouTube pode estar bloqueando a requisição"
 
+    except DownloadRefused as e:
+        print(f"[DEBUG] 🚫 Download recusado: {e.msg}")
+        cleanup_partial_downloads(mp3_file.replace('.mp3', ''))
+        raise
+    except DownloadCancelled as e:
+        print(f"[DEBUG] ⏹️ {e.msg}: {url}")
+        cleanup_partial_downloads(mp3_file.replace('.mp3', ''))
+        return False, None, e.msg
     except Exception as e:
         print(f"[DEBUG] Erro geral: {type(e).__name__}: {str(e)}")
         return False, None, str(e)
@@ -422,74 +1040,987 @@ def get_video_info(url):
     except Exception as e:
         return None, str(e)
 
+def get_playlist_entries(url, limit=IMPORT_MAX_ITEMS):
+    """List the first limit videos of a YouTube playlist with flat extraction (one request, no per-video pages)"""
+    try:
+        ydl_opts = get_ydl_opts(use_cookies=False)
+        ydl_opts.update({
+            'extract_flat': 'in_playlist',
+            'playlistend': limit,
+        })
+        
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+        entries = [
+            {"url": f"https://www.youtube.com/watch?v={entry['id']}", "title": entry.get('title')}
+            for entry in info.get('entries') or [] if entry and entry.get('id')
+        ]
+        return entries, None
+    except Exception as e:
+        return None, str(e)
+
+def is_youtube_playlist_url(url):
+    pattern = r"^(https?://)?(www\.|m\.)?youtube\.com/playlist\?(\S*&)?list=[\w-]+"
+    return re.match(pattern, url) is not None
+
 def is_valid_youtube_url(url):
     pattern = r"^(https?://)?(www\.)?(youtube\.com/(watch\?v=|shorts/)[\w-]+(\?\S*)?(&\S*)?|youtu\.be/[\w-]+(\?\S*)?)$"
     return re.match(pattern, url) is not None
 
+def extract_video_id(url):
+    """Extract the YouTube video ID (used as the cache key)"""
+    match = re.search(r"(?:[?&]v=|shorts/|youtu\.be/)([\w-]+)", url)
+    if match:
+        return match.group(1)
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
 
-@app.route('/video_info', methods=['POST'])
-def video_info():
-    data = request.get_json()
+# Video metadata shared by bot commands and the HTTP API: {video_id: (expires_at, video_info)}
+video_info_cache = {}
+# Extractions in progress, so concurrent requests for the same video wait for one: {video_id: Task}
+_video_info_inflight = {}
+
+async def fetch_video_info(url, trace=None):
+    """
+    get_video_info through the shared executor, with a VIDEO_INFO_TTL cache and in-flight coalescing.
+    The extraction runs in its own task, so cancelling one caller doesn't fail the others.
+    """
+    video_id = extract_video_id(url)
+    cached = video_info_cache.get(video_id)
+    if cached and cached[0] > asyncio.get_running_loop().time():
+        return cached[1], None
+
+    task = _video_info_inflight.get(video_id)
+    if task is None:
+        task = spawn(_extract_video_info(url, video_id, trace))
+        _video_info_inflight[video_id] = task
+
+        def forget(_):
+            if _video_info_inflight.get(video_id) is task:
+                del _video_info_inflight[video_id]
+
+        task.add_done_callback(forget)
+    return await asyncio.shield(task)
+
+async def _extract_video_info(url, video_id, trace):
+    result = await run_traced(trace, 'metadata', get_video_info, url)
+    video_info, error = result
+    if video_info:
+        now = asyncio.get_running_loop().time()
+        video_info_cache[video_id] = (now + VIDEO_INFO_TTL, video_info)
+        # Drop expired entries now and then so the cache stays bounded by what is in use
+        if len(video_info_cache) % 256 == 0:
+            for key, (expires_at, _) in list(video_info_cache.items()):
+                if expires_at <= now:
+                    del video_info_cache[key]
+    return result
+
+def get_available_resolutions(url):
+    try:
+        ydl_opts = get_ydl_opts(use_cookies=False)
+        
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            formats = info.get('formats', [])
+            
+            resolutions = list(set([
+                f.get('height', 0) 
+                for f in formats 
+                if f.get('height') and f.get('vcodec') != 'none'
+            ]))
+            
+            return sorted([f"{r}p" for r in resolutions if r > 0]), None
+    except Exception as e:
+        return None, str(e)
+
+
+# Titles flat extraction gives to videos that can no longer be played
+UNAVAILABLE_TITLES = ('[Deleted video]', '[Private video]')
+
+async def importar_para_playlist(playlist_name, urls, on_progress=None):
+    """
+    Bulk-add videos and whole YouTube playlists (flat extraction) to a playlist.
+    Duplicates are skipped by video ID, missing titles are fetched IMPORT_PARALLELISM at a time
+    (on_progress(done, total) after each) and all songs are saved in one write.
+    At most IMPORT_MAX_ITEMS URLs are accepted, and playlists stop being expanded once that many
+    videos have been collected.
+    Returns (items, error): one {'url', 'title', 'status', 'error'} per video, with status
+    'added', 'duplicate', 'invalid' or 'error'.
+    """
+    if len(urls) > IMPORT_MAX_ITEMS:
+        return None, f"Máximo de {IMPORT_MAX_ITEMS} URLs por importação"
+    existing, error = carregar_playlist(playlist_name)
+    if error:
+        return None, error
+
+    loop = asyncio.get_running_loop()
+    limit_error = f"Limite de {IMPORT_MAX_ITEMS} músicas por importação"
+    items = []
+    for url in urls:
+        if is_youtube_playlist_url(url):
+            room = IMPORT_MAX_ITEMS - sum(1 for item in items if not item['status'])
+            if room <= 0:
+                items.append({'url': url, 'title': None, 'status': 'error', 'error': limit_error})
+                continue
+            entries, error = await loop.run_in_executor(None, get_playlist_entries, url, room)
+            if error:
+                items.append({'url': url, 'title': None, 'status': 'error', 'error': error})
+                continue
+            for entry in entries:
+                unavailable = entry['title'] in UNAVAILABLE_TITLES
+                items.append({
+                    'url': entry['url'],
+                    'title': None if unavailable else entry['title'],
+                    'status': 'error' if unavailable else None,
+                    'error': "Vídeo indisponível" if unavailable else None,
+                })
+        elif is_valid_youtube_url(url):
+            items.append({'url': url, 'title': None, 'status': None, 'error': None})
+        else:
+            items.append({'url': url, 'title': None, 'status': 'invalid', 'error': "URL do YouTube inválida"})
+
+    seen = {extract_video_id(song['url']) for song in existing}
+    pending = []
+    for item in items:
+        if item['status']:
+            continue
+        video_id = extract_video_id(item['url'])
+        if video_id in seen:
+            item['status'] = 'duplicate'
+        elif len(pending) >= IMPORT_MAX_ITEMS:
+            item['status'], item['error'] = 'error', limit_error
+        else:
+            seen.add(video_id)
+            pending.append(item)
+
+    semaphore = asyncio.Semaphore(max(1, IMPORT_PARALLELISM))
+    done = 0
+
+    async def resolve_title(item):
+        nonlocal done
+        if not item['title']:
+            async with semaphore:
+                video_info, error = await fetch_video_info(item['url'])
+            if video_info:
+                item['title'] = video_info.get('title') or "Sem título"
+            else:
+                item['status'], item['error'] = 'error', error
+        done += 1
+        if on_progress:
+            on_progress(done, len(pending))
+
+    await asyncio.gather(*(resolve_title(item) for item in pending))
+
+    songs = [item for item in pending if not item['status']]
+    added, error = adicionar_varias_a_playlist(playlist_name, songs)
+    if error:
+        return None, error
+    added_urls = {song['url'] for song in added}
+    for item in songs:
+        # Not added: a concurrent !adicionar_a_playlist got there first
+        item['status'] = 'added' if item['url'] in added_urls else 'duplicate'
+    return items, None
+
+@routes.post('/import_playlist')
+async def import_playlist(request):
+    data = await read_json(request)
+    playlist_name = data.get('playlist')
+    urls = data.get('urls')
+    
+    if not playlist_name or not isinstance(urls, list) or not urls:
+        return web.json_response({"error": "Parâmetros 'playlist' e 'urls' (lista) são obrigatórios."}, status=400)
+    if len(urls) > IMPORT_MAX_ITEMS:
+        return web.json_response({"error": f"Máximo de {IMPORT_MAX_ITEMS} URLs por importação."}, status=400)
+    
+    items, error = await importar_para_playlist(playlist_name, [str(url) for url in urls])
+    if error:
+        return web.json_response({"error": error}, status=404 if error == "Playlist não encontrada" else 500)
+    added = sum(1 for item in items if item['status'] == 'added')
+    return web.json_response({"added": added, "items": items}, status=200)
+
+
+@routes.post('/video_info')
+async def video_info(request):
+    data = await read_json(request)
     url = data.get('url')
     
     if not url:
-        return jsonify({"error": "Parâmetro 'url' ausente."}), 400
+        return web.json_response({"error": "Parâmetro 'url' ausente."}, status=400)
 
     if not is_valid_youtube_url(url):
-        return jsonify({"error": "URL do YouTube inválida."}), 400
+        return web.json_response({"error": "URL do YouTube inválida."}, status=400)
     
-    video_info, error_message = get_video_info(url)
+    video_info, error_message = await fetch_video_info(url)
     
     if video_info:
-        return jsonify(video_info), 200
+        return web.json_response(video_info, status=200)
     else:
-        return jsonify({"error": error_message}), 500
+        return web.json_response({"error": error_message}, status=500)
 
 
-@app.route('/available_resolutions', methods=['POST'])
-def available_resolutions():
-    data = request.get_json()
+@routes.post('/available_resolutions')
+async def available_resolutions(request):
+    data = await read_json(request)
     url = data.get('url')
     
     if not url:
-        return jsonify({"error": "Parâmetro 'url' ausente."}), 400
+        return web.json_response({"error": "Parâmetro 'url' ausente."}, status=400)
 
     if not is_valid_youtube_url(url):
-        return jsonify({"error": "URL do YouTube inválida."}), 400
+        return web.json_response({"error": "URL do YouTube inválida."}, status=400)
     
+    loop = asyncio.get_running_loop()
+    resolutions, error = await loop.run_in_executor(None, get_available_resolutions, url)
+    if error:
+        return web.json_response({"error": error}, status=500)
+    return web.json_response({"resolutions": resolutions}, status=200)
+
+
+# ============= AUDIO CACHE / PROGRESSIVE PLAYBACK =============
+
+# In-flight progressive downloads, shared by every guild playing the same video: {(video_id, kbps): ProgressiveDownload}
+progressive_downloads = {}
+
+def opus_kbps_for(channel=None):
+    """Encode bitrate (kbps) for a voice channel: the smallest tier covering channel.bitrate"""
+    bitrate = getattr(channel, 'bitrate', None)
+    target = bitrate // 1000 if bitrate else int(OPUS_BITRATE.rstrip('k'))
+    for tier in OPUS_BITRATE_TIERS:
+        if tier >= target:
+            return tier
+    return OPUS_BITRATE_TIERS[-1]
+
+def cache_path_for(video_id, kbps):
+    """Get cache file path for a video encoded at kbps"""
+    return os.path.join(AUDIO_CACHE_DIR, f"{video_id}.{kbps}.opus")
+
+def is_cached_path(file_path):
+    """Check if a file belongs to the audio cache (and must outlive playback)"""
+    return os.path.dirname(os.path.abspath(file_path)) == AUDIO_CACHE_DIR
+
+def get_cached_audio(video_id, kbps):
+    """
+    Return the smallest cached file of a video encoded at kbps or more (refreshing its LRU
+    position), or None; a lower-bitrate copy doesn't count, so it gets upgraded.
+    """
+    for tier in OPUS_BITRATE_TIERS:
+        if tier < kbps:
+            continue
+        path = cache_path_for(video_id, tier)
+        if not os.path.exists(path):
+            continue
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return path
+    return None
+
+def read_cached_admission(path):
+    """admission_fields() saved next to a cached file when it was downloaded ({} if missing)"""
     try:
-        ydl_opts = get_ydl_opts(use_cookies=False)
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = info.get('formats', [])
-            
-            resolutions = list(set([
-                f.get('height', 0) 
-                for f in formats 
-                if f.get('height') and f.get('vcodec') != 'none'
-            ]))
-            
-            return jsonify({
-                "resolutions": sorted([f"{r}p" for r in resolutions if r > 0])
-            }), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        with open(path + '.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def remove_cached_audio(path):
+    """Delete a cached file and its admission sidecar"""
+    cleanup_file(path)
+    cleanup_file(path + '.json')
+
+def find_download(video_id, kbps):
+    """In-flight download of a video at kbps or more"""
+    for tier in OPUS_BITRATE_TIERS:
+        if tier >= kbps and (video_id, tier) in progressive_downloads:
+            return progressive_downloads[(video_id, tier)]
+    return None
+
+def cache_entries():
+    """(mtime, size, path, video_id) of every file in the audio cache"""
+    entries = []
+    for name in os.listdir(AUDIO_CACHE_DIR):
+        # Admission sidecars (.json) go away with their audio file
+        if name.endswith('.part') or name.endswith('.json'):
+            continue
+        path = os.path.join(AUDIO_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path, name.split('.')[0]))
+    return entries
+
+def pinned_cache_bytes(pinned=None):
+    """Bytes of the audio cache held by songs of pinned playlists"""
+    pinned = pinned_video_ids() if pinned is None else pinned
+    return sum(size for _, size, _, video_id in cache_entries() if video_id in pinned)
+
+def enforce_cache_limit():
+    """
+    Evict least recently used cache files until the cache fits AUDIO_CACHE_MAX_BYTES.
+    Songs of pinned playlists count towards the limit and are kept, most recently used first,
+    up to PINNED_CACHE_MAX_BYTES; past that budget they are evicted like any other file.
+    """
+    pinned = pinned_video_ids()
+    entries = []
+    pinned_entries = []
+    total = 0
+    for mtime, size, path, video_id in cache_entries():
+        total += size
+        (pinned_entries if video_id in pinned else entries).append((mtime, size, path))
+
+    kept = 0
+    for entry in sorted(pinned_entries, reverse=True):
+        if kept + entry[1] <= PINNED_CACHE_MAX_BYTES:
+            kept += entry[1]
+        else:
+            entries.append(entry)
+
+    for _, size, path in sorted(entries):
+        if total <= AUDIO_CACHE_MAX_BYTES:
+            break
+        remove_cached_audio(path)
+        total -= size
+
+def cleanup_partial_cache():
+    """Remove leftover .part files from downloads interrupted by a restart"""
+    for name in os.listdir(AUDIO_CACHE_DIR):
+        if name.endswith('.part'):
+            cleanup_file(os.path.join(AUDIO_CACHE_DIR, name))
+
+def resolve_audio_stream(url, kbps=None):
+    """
+    Resolve the direct audio stream URL (and its HTTP headers) without downloading,
+    preferring the smallest format that covers kbps
+    """
+    for idx, strategy in enumerate(get_download_strategies(kbps), 1):
+        try:
+            ydl_opts = get_ydl_opts(use_cookies=strategy['cookies'])
+            ydl_opts.update({
+                'format': strategy['format'],
+                'format_sort': strategy.get('format_sort', []),
+                'check_formats': False,
+                'socket_timeout': 30,
+            })
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+            if info and info.get('url'):
+                return info, None
+        except Exception as e:
+            print(f"[DEBUG] ❌ {strategy['name']}: {type(e).__name__}: {str(e)[:100]}")
+    return None, "Não foi possível obter o áudio do vídeo - YouTube pode estar bloqueando a requisição"
+
+class ProgressiveDownload:
+    """
+    Download + transcode to Ogg Opus with FFmpeg straight into the cache, exposing bytes as they arrive.
+    A pump thread tees FFmpeg's stdout into the .part file and wakes up the readers;
+    when FFmpeg finishes, the .part file is moved into the cache.
+    """
+
+    def __init__(self, video_id, kbps, admission=None, max_mb=None):
+        self.video_id = video_id
+        self.kbps = kbps
+        self.admission = admission or {}  # admission_fields() of the video, checked for later joiners
+        self.max_mb = max_mb
+        self.oversized = False
+        self.cache_path = cache_path_for(video_id, kbps)
+        self.part_path = self.cache_path + '.part'
+        self.size = 0
+        self.done = False
+        self.finalized = False
+        self.error = None
+        self.cancelled = False
+        self.process = None
+        self.owners = set()  # Guilds waiting for / playing this download
+        self._cond = threading.Condition()
+
+    def start(self, stream_url, headers=None):
+        args = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if headers:
+            args += ['-headers', ''.join(f"{key}: {value}\r\n" for key, value in headers.items())]
+        args += [
+            '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+            '-i', stream_url,
+            '-vn', '-c:a', 'libopus', '-b:a', f"{self.kbps}k", '-ar', OPUS_SAMPLE_RATE, '-ac', '2',
+            '-frame_duration', '20', '-application', 'audio',
+            '-f', 'opus', 'pipe:1',
+        ]
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _pump(self):
+        try:
+            with open(self.part_path, 'wb') as f:
+                while True:
+                    chunk = self.process.stdout.read1(64 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    f.flush()
+                    with self._cond:
+                        self.size += len(chunk)
+                        self._cond.notify_all()
+                    if self.max_mb and self.size > self.max_mb * 1024 * 1024:
+                        self.oversized = True
+                        self.process.kill()
+                        break
+            returncode = self.process.wait()
+            if self.cancelled:
+                self.error = DownloadCancelled.msg
+            elif self.oversized:
+                self.error = DownloadTooLarge(self.max_mb).msg
+            elif returncode != 0 or self.size == 0:
+                self.error = f"FFmpeg terminou com código {returncode}"
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            with self._cond:
+                if self.error:
+                    if self.cancelled:
+                        print(f"[DEBUG] ⏹️ Download progressivo cancelado ({self.video_id})")
+                    else:
+                        print(f"[DEBUG] ❌ Download progressivo falhou ({self.video_id}): {self.error}")
+                    cleanup_file(self.part_path)
+                else:
+                    try:
+                        # Guilds with other limits check these on later cache hits
+                        with open(self.cache_path + '.json', 'w', encoding='utf-8') as f:
+                            json.dump(self.admission, f)
+                        os.replace(self.part_path, self.cache_path)
+                        self.finalized = True
+                        print(f"[DEBUG] ✅ Download progressivo concluído ({self.video_id}, {self.kbps}k): {self.size} bytes")
+                    except OSError as e:
+                        self.error = str(e)
+                self.done = True
+                self._cond.notify_all()
+            key = (self.video_id, self.kbps)
+            if progressive_downloads.get(key) is self:
+                progressive_downloads.pop(key, None)
+            if self.finalized:
+                # Upgraded: lower-bitrate copies are never picked again
+                for tier in OPUS_BITRATE_TIERS:
+                    if tier < self.kbps:
+                        remove_cached_audio(cache_path_for(self.video_id, tier))
+                enforce_cache_limit()
+
+    def cancel(self):
+        """Kill FFmpeg; the pump thread then removes the partial file"""
+        with self._cond:
+            if self.done:
+                return
+            self.cancelled = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+    def release(self, owner):
+        """Drop an owner; the download is cancelled once nobody else needs it"""
+        self.owners.discard(owner)
+        if not self.owners:
+            self.cancel()
+
+    def wait_ready(self, nbytes, timeout):
+        """Block until nbytes are buffered or the download ends; returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.size >= nbytes or self.done, timeout)
+
+    def wait_done(self, timeout=None):
+        """Block until the download ends; returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def open_reader(self):
+        return ProgressiveReader(self)
+
+class ProgressiveReader:
+    """
+    File-like view of a ProgressiveDownload.
+    read(size) waits until size bytes exist instead of returning short reads or EOF while the
+    download is still running (close() wakes it up). The .part file is reopened on every read so it
+    can be moved into the cache meanwhile; the cached file is then kept open, so an upgrade or an
+    eviction removing it doesn't cut the song short.
+    """
 
+    def __init__(self, download):
+        self.download = download
+        self.position = 0
+        self.closed = False
+        self._file = None
+
+    def read(self, size=-1):
+        download = self.download
+        with download._cond:
+            while not self.closed and not download.done and (size is None or size < 0 or download.size < self.position + size):
+                download._cond.wait()
+            if self.closed or download.error or self.position >= download.size:
+                return b''
+
+            end = download.size if size is None or size < 0 else min(download.size, self.position + size)
+            try:
+                if download.finalized:
+                    if self._file is None:
+                        self._file = open(download.cache_path, 'rb')
+                    self._file.seek(self.position)
+                    data = self._file.read(end - self.position)
+                else:
+                    with open(download.part_path, 'rb') as f:
+                        f.seek(self.position)
+                        data = f.read(end - self.position)
+            except OSError as e:
+                print(f"[DEBUG] ⚠️ Arquivo de áudio indisponível ({download.video_id}): {e}")
+                return b''
+        self.position += len(data)
+        return data
+
+    def close(self):
+        with self.download._cond:
+            self.closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.download._cond.notify_all()
+
+class OpusPacketAudio(discord.AudioSource):
+    """
+    Plays pre-encoded Ogg Opus packets as they are: no FFmpeg child process and no
+    per-frame Opus encoding. Cached files are memory-mapped; in-progress downloads are
+    played through ProgressiveOpusAudio.
+    """
+
+    def __init__(self, stream, closables=()):
+        self._closables = closables
+        self._packets = OggStream(stream).iter_packets()
+
+    @classmethod
+    def from_file(cls, path):
+        f = open(path, 'rb')
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            f.close()
+            raise
+        return cls(mapped, closables=(mapped, f))
+
+    def read(self):
+        try:
+            for packet in self._packets:
+                # Skip the identification and comment headers
+                if packet[:8] in (b'OpusHead', b'OpusTags'):
+                    continue
+                return packet
+        except OggError as e:
+            # Truncated stream (e.g. download cancelled mid-page)
+            print(f"[DEBUG] ⚠️ Stream Opus inválido: {e}")
+        return b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        for closable in self._closables:
+            try:
+                closable.close()
+            except (ValueError, OSError):
+                pass
+        self._closables = ()
+
+class ProgressiveOpusAudio(OpusPacketAudio):
+    """
+    OpusPacketAudio over a ProgressiveReader. A feeder thread parses packets ahead of the player,
+    so read() never blocks: while the download is stalled it returns Opus silence on the player's
+    20ms clock. Blocking instead would make discord.py send every late packet back to back once
+    data arrives. The track ends if the stall lasts PROGRESSIVE_STALL_TIMEOUT.
+    """
+
+    def __init__(self, reader):
+        super().__init__(reader, closables=(reader,))
+        self._buffer = queue.Queue(maxsize=250)  # ~5s of packets
+        self._closed = threading.Event()
+        self._stalled_since = None
+        self._ended = False
+        threading.Thread(target=self._feed, daemon=True).start()
+
+    def _feed(self):
+        while not self._closed.is_set():
+            packet = super().read()
+            while not self._closed.is_set():
+                try:
+                    self._buffer.put(packet, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if not packet:
+                return
+
+    def read(self):
+        if self._ended:
+            return b''
+        try:
+            packet = self._buffer.get_nowait()
+        except queue.Empty:
+            now = time.monotonic()
+            if self._stalled_since is None:
+                self._stalled_since = now
+                print("[DEBUG] ⚠️ Download atrasado, tocando silêncio")
+            elif now - self._stalled_since > PROGRESSIVE_STALL_TIMEOUT:
+                print(f"[DEBUG] ⚠️ Download parado há {PROGRESSIVE_STALL_TIMEOUT}s, encerrando a música")
+                self._ended = True
+                return b''
+            return OPUS_SILENCE
+        self._stalled_since = None
+        if not packet:
+            self._ended = True
+        return packet
+
+    def cleanup(self):
+        self._closed.set()
+        super().cleanup()
+
+def cancel_downloads(guild_id):
+    """Cancel every download started for a guild (stop/skip/disconnect)"""
+    queue_data = get_queue(guild_id)
+    queue_data['generation'] += 1
+    for download in queue_data['downloads']:
+        download.release(guild_id)
+    queue_data['downloads'].clear()
+
+async def get_or_start_download(url, video_id, kbps, limits, trace=None, cancelled=None):
+    """
+    Join the running download of a video (at kbps or more) or resolve its stream and start a new one.
+    Returns (download, error); no download is started if cancelled() turns true while resolving
+    or the video is outside limits.
+    """
+    download = find_download(video_id, kbps)
+    if download is not None:
+        rejected = check_admission(download.admission, limits)
+        return (None, rejected) if rejected else (download, None)
+
+    info, error = await run_traced(trace, 'download', resolve_audio_stream, url, kbps)
+    if cancelled is not None and cancelled():
+        return None, None
+    if not info:
+        return None, error
+    rejected = check_admission(info, limits)
+    if rejected:
+        print(f"[DEBUG] 🚫 Download recusado ({video_id}): {rejected}")
+        return None, rejected
+    # Another command may have started the same download meanwhile
+    download = find_download(video_id, kbps)
+    if download is None:
+        download = ProgressiveDownload(video_id, kbps, admission_fields(info), limits['max_mb'])
+        spawn_started = time.perf_counter()
+        try:
+            download.start(info['url'], info.get('http_headers'))
+        except OSError as e:
+            return None, f"Erro ao iniciar FFmpeg: {e}"
+        if trace is not None:
+            trace.add('ffmpeg_spawn', time.perf_counter() - spawn_started)
+        progressive_downloads[(video_id, kbps)] = download
+    return download, None
+
+async def materialize_song(url, budget=None):
+    """
+    Download a song into the audio cache (at the default bitrate) without playing it.
+    With budget ({'remaining': bytes}), the song's expected size is reserved from it first and
+    the song is skipped if it doesn't fit.
+    Returns (status, error) with status 'cached', 'downloaded' or 'skipped'.
+    """
+    video_id = extract_video_id(url)
+    kbps = opus_kbps_for()
+    if get_cached_audio(video_id, kbps):
+        return 'cached', None
+
+    reserved = 0
+    if budget is not None:
+        video_info, error = await fetch_video_info(url)
+        duration = video_info.get('length') if video_info else None
+        if not duration:
+            return 'skipped', error or "Duração desconhecida"
+        reserved = int(duration * kbps * 1000 / 8)
+        if reserved > budget['remaining']:
+            return 'skipped', (
+                f"Não cabe no cache fixo (~{reserved / 1024 / 1024:.0f}MB, "
+                f"restam {max(0, budget['remaining']) / 1024 / 1024:.0f}MB)"
+            )
+        budget['remaining'] -= reserved
+
+    download, error = await get_or_start_download(url, video_id, kbps, get_limits())
+    if not download:
+        if budget is not None:
+            budget['remaining'] += reserved
+        return None, error
+
+    # Keeps a guild's !parar/!proximo from killing a download that is shared with us
+    owner = ('materialize', id(asyncio.current_task()))
+    download.owners.add(owner)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, download.wait_done)
+    finally:
+        download.owners.discard(owner)
+    if budget is not None:
+        # Swap the estimate for the real size
+        budget['remaining'] += reserved - (download.size if download.finalized else 0)
+    if download.error:
+        return None, download.error
+    if download.cancelled:
+        return None, "Download cancelado"
+    return 'downloaded', None
+
+async def materialize_playlist(songs, on_progress=None):
+    """
+    Download every song of a playlist into the audio cache, MATERIALIZE_PARALLELISM at a time.
+    Songs of pinned playlists must fit what is left of PINNED_CACHE_MAX_BYTES; the others are skipped.
+    on_progress(progress) is called after each song; returns the final progress dict.
+    """
+    progress = {'total': len(songs), 'done': 0, 'cached': 0, 'downloaded': 0, 'skipped': [], 'errors': []}
+    semaphore = asyncio.Semaphore(max(1, MATERIALIZE_PARALLELISM))
+    pinned = pinned_video_ids()
+    budget = {'remaining': PINNED_CACHE_MAX_BYTES - pinned_cache_bytes(pinned)}
+
+    async def worker(song):
+        async with semaphore:
+            pinned_song = extract_video_id(song['url']) in pinned
+            status, error = await materialize_song(song['url'], budget if pinned_song else None)
+        progress['done'] += 1
+        if status == 'skipped':
+            progress['skipped'].append((song.get('title') or song['url'], error))
+            print(f"[DEBUG] ⏭️ Música fixada ignorada {song['url']}: {error}")
+        elif status:
+            progress[status] += 1
+        else:
+            progress['errors'].append((song.get('title') or song['url'], error))
+            print(f"[DEBUG] ❌ Falha ao materializar {song['url']}: {error}")
+        if on_progress:
+            on_progress(progress)
+
+    await asyncio.gather(*(worker(song) for song in songs))
+    return progress
+
+async def prepare_audio(url, guild_id, trace=None, channel=None):
+    """
+    Prepare an audio source for a URL, encoded to cover the bitrate of the voice channel.
+    Cached tracks play from disk; otherwise playback starts once PROGRESSIVE_PREBUFFER_SECONDS
+    are buffered, while the rest of the download keeps landing in the cache.
+    Videos outside the guild's admission limits are refused with an error.
+    Returns (source, path, error); raises DownloadCancelled if cancel_downloads(guild_id)
+    is called meanwhile. Resolve and pre-buffer time is recorded on trace as 'download'.
+    """
+    queue_data = get_queue(guild_id)
+    generation = queue_data['generation']
+    video_id = extract_video_id(url)
+    kbps = opus_kbps_for(channel)
+    limits = get_limits(guild_id)
+    cached = get_cached_audio(video_id, kbps)
+    if cached:
+        # Possibly cached for a guild with looser limits
+        rejected = check_admission(read_cached_admission(cached), limits)
+        if not rejected and os.path.getsize(cached) > limits['max_mb'] * 1024 * 1024:
+            rejected = f"Áudio excede o limite de {limits['max_mb']:g}MB deste servidor"
+        if rejected:
+            return None, None, rejected
+        print(f"[DEBUG] 💾 Cache hit: {video_id}")
+        try:
+            return OpusPacketAudio.from_file(cached), cached, None
+        except (ValueError, OSError) as e:
+            # Empty or unreadable file: drop it and download again
+            print(f"[DEBUG] ⚠️ Cache inválido ({video_id}): {e}")
+            remove_cached_audio(cached)
+
+    download, error = await get_or_start_download(
+        url, video_id, kbps, limits, trace, cancelled=lambda: queue_data['generation'] != generation
+    )
+    if queue_data['generation'] != generation:
+        raise DownloadCancelled()
+    if not download:
+        return None, None, error
+
+    download.owners.add(guild_id)
+    queue_data['downloads'].difference_update([d for d in queue_data['downloads'] if d.done])
+    queue_data['downloads'].add(download)
+
+    prebuffer_bytes = int(PROGRESSIVE_PREBUFFER_SECONDS * download.kbps * 1000 / 8)
+    try:
+        ready = await run_traced(trace, 'download', download.wait_ready, prebuffer_bytes, PROGRESSIVE_STALL_TIMEOUT)
+    except asyncio.CancelledError:
+        queue_data['downloads'].discard(download)
+        download.release(guild_id)
+        raise
+    if queue_data['generation'] != generation or download.cancelled:
+        raise DownloadCancelled()
+    if download.error:
+        return None, None, download.error
+    if not ready:
+        return None, None, "Tempo esgotado aguardando o início do download"
+
+    return ProgressiveOpusAudio(download.open_reader()), download.cache_path, None
+
+def start_playback(ctx, voice_client, audio, trace=None):
+    """
+    Play an audio source and chain play_next when it finishes.
+    Returns False (closing the source) if another command started playing meanwhile;
+    the caller should queue the song instead.
+    """
+    if voice_client.is_playing() or voice_client.is_paused():
+        audio.cleanup()
+        return False
+
+    loop = asyncio.get_running_loop()
+
+    if trace is not None:
+        played_at = time.perf_counter()
+
+        def on_first_packet():
+            trace.add('first_packet', time.perf_counter() - played_at)
+            loop.call_soon_threadsafe(trace.finish, 'played')
+
+        audio = FirstPacketProbe(audio, on_first_packet)
+
+    def after_play(err):
+        if err:
+            print(f"Playback error: {err}")
+        # Play next song when this one finishes
+        asyncio.run_coroutine_threadsafe(play_next(ctx), loop)
+
+    cancel_idle_disconnect(ctx.guild.id)
+    voice_client.play(audio, after=after_play)
+    return True
+
+async def connect_and_prepare(ctx, url, trace):
+    """
+    Join the author's voice channel and buffer the audio of url at the same time.
+    Returns (voice_client, audio, audio_path, error). If joining fails the download is
+    cancelled and everything is None (ensure_voice already told the user why).
+    Raises DownloadCancelled like prepare_audio.
+    The guild counts as preparing meanwhile, so the idle timer leaves the connection alone;
+    if no audio comes out of it, the timer is armed again.
+    """
+    async def connect():
+        with trace.span('voice_connect'):
+            return await ensure_voice(ctx)
+
+    prepared = False
+    try:
+        with preparing_audio(ctx.guild.id):
+            # The handshake itself is never cancelled: that leaves a half-open voice client behind.
+            # If the audio fails first, it finishes in the background and the idle timer disconnects.
+            voice_task = spawn(connect())
+            channel = ctx.author.voice.channel if ctx.author.voice else None
+            audio_task = asyncio.create_task(prepare_audio(url, ctx.guild.id, trace, channel))
+            try:
+                await asyncio.wait((voice_task, audio_task), return_when=asyncio.FIRST_COMPLETED)
+                if voice_task.done() and not voice_task.result():
+                    return None, None, None, None
+                audio, audio_path, error = await audio_task
+                if not audio:
+                    return None, None, None, error
+                try:
+                    voice_client = await voice_task
+                except BaseException:
+                    audio.cleanup()
+                    raise
+                if not voice_client:
+                    audio.cleanup()
+                    return None, None, None, None
+                prepared = True
+                return voice_client, audio, audio_path, None
+            finally:
+                audio_task.cancel()
+    finally:
+        if not prepared:
+            arm_idle_disconnect(ctx.guild.id, ctx.voice_client)
+
+def release_current(queue_data):
+    """Forget the current song, deleting its file unless it belongs to the audio cache"""
+    if queue_data['current'] and not is_cached_path(queue_data['current']):
+        cleanup_file(queue_data['current'])
+    queue_data['current'] = None
+
+# ============= END AUDIO CACHE / PROGRESSIVE PLAYBACK =============
+
+
+# Voice connection reuse: cold connects (full handshake) vs. warm connections kept by the idle grace
+voice_stats = {'cold_connects': 0, 'cold_seconds': 0.0, 'warm_reuses': 0}
+_voice_connects = {}  # guild_id -> handshake in progress
 
 async def ensure_voice(ctx):
     if not ctx.author.voice or not ctx.author.voice.channel:
-        await ctx.send("Você precisa estar em um canal de voz.")
+        await reply(ctx, "Você precisa estar em um canal de voz.")
         return None
 
     channel = ctx.author.voice.channel
     if ctx.voice_client:
+        if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
+            voice_stats['warm_reuses'] += 1
+            # The caller is about to use the connection; it re-arms the timer if nothing plays
+            cancel_idle_disconnect(ctx.guild.id)
         if ctx.voice_client.channel != channel:
             await ctx.voice_client.move_to(channel)
     else:
-        await channel.connect()
+        # Concurrent commands share one handshake instead of connecting twice
+        connecting = _voice_connects.get(ctx.guild.id)
+        if connecting is None:
+            guild_id = ctx.guild.id
+            connecting = spawn(_connect_voice(ctx, channel))
+            _voice_connects[guild_id] = connecting
+            connecting.add_done_callback(lambda _: _voice_connects.pop(guild_id, None))
+        await asyncio.shield(connecting)
     return ctx.voice_client
 
+async def _connect_voice(ctx, channel):
+    started = time.perf_counter()
+    await channel.connect()
+    voice_stats['cold_connects'] += 1
+    voice_stats['cold_seconds'] += time.perf_counter() - started
+    # Don't hold the connection forever if nothing ends up playing
+    arm_idle_disconnect(ctx.guild.id, ctx.voice_client)
+
+@contextlib.contextmanager
+def preparing_audio(guild_id):
+    """Mark a guild as loading a song to play, so the idle timer doesn't disconnect it meanwhile"""
+    queue_data = get_queue(guild_id)
+    queue_data['preparing'] += 1
+    try:
+        yield
+    finally:
+        queue_data['preparing'] -= 1
+
+def arm_idle_disconnect(guild_id, voice_client):
+    """
+    Schedule the idle timer unless the connection is in use: playing, paused or a command
+    still preparing audio (which arms the timer itself if nothing ends up playing)
+    """
+    if voice_client is None or not voice_client.is_connected():
+        return
+    if voice_client.is_playing() or voice_client.is_paused() or get_queue(guild_id)['preparing']:
+        return
+    schedule_idle_disconnect(guild_id, voice_client)
+
+def cancel_idle_disconnect(guild_id):
+    """Stop the idle timer of a guild (playback started or the bot is leaving anyway)"""
+    queue_data = get_queue(guild_id)
+    task, queue_data['idle_task'] = queue_data['idle_task'], None
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+
+def schedule_idle_disconnect(guild_id, voice_client):
+    """Keep an idle voice connection warm for VOICE_IDLE_GRACE seconds, then disconnect"""
+    cancel_idle_disconnect(guild_id)
+    get_queue(guild_id)['idle_task'] = spawn(_idle_disconnect(guild_id, voice_client))
+
+async def _idle_disconnect(guild_id, voice_client):
+    try:
+        await asyncio.sleep(VOICE_IDLE_GRACE)
+        if not voice_client.is_connected() or voice_client.is_playing() or voice_client.is_paused():
+            return
+        # A command is still preparing its song (downloads included): it arms the timer again if nothing plays
+        if get_queue(guild_id)['preparing']:
+            return
+        print(f"[DEBUG] 🔌 Desconectando por inatividade (servidor {guild_id})")
+        await voice_client.disconnect()
+    finally:
+        queue_data = music_queues.get(guild_id)
+        if queue_data is not None and queue_data['idle_task'] is asyncio.current_task():
+            queue_data['idle_task'] = None
+
 
 def cleanup_downloads_dir():
     """Clean up old files in downloads directory"""
@@ -510,58 +2041,123 @@ async def play_next(ctx):
     
     if not voice_client or not voice_client.is_connected():
         # Clean up current file and clear queue
-        if queue_data['current']:
-            cleanup_file(queue_data['current'])
-            queue_data['current'] = None
+        release_current(queue_data)
         queue_data['queue'].clear()
         return
     
     # Clean up previous song
-    if queue_data['current']:
-        cleanup_file(queue_data['current'])
-        queue_data['current'] = None
+    release_current(queue_data)
     
     # Check if there's a next song
     if not queue_data['queue']:
-        await ctx.send("🎵 Fila vazia. Desconectando...")
-        await voice_client.disconnect()
+        if queue_data['preparing']:
+            # A !tocar is loading a song: it starts playing or arms the idle timer
+            return
+        if VOICE_IDLE_GRACE <= 0:
+            await reply(ctx, "🎵 Fila vazia. Desconectando...", essential=False)
+            await voice_client.disconnect()
+            return
+        # Stay connected for a while so the next !tocar skips the voice handshake
+        schedule_idle_disconnect(ctx.guild.id, voice_client)
+        await reply(ctx, f"🎵 Fila vazia. Desconectando em {VOICE_IDLE_GRACE:.0f}s se nada mais for tocado.", essential=False)
         return
     
     # Get next song from queue
-    url, title = queue_data['queue'].pop(0)
-    await ctx.send(f"⏭️ Tocando próxima: **{title}**")
+    track = queue_data['queue'].pop(0)
+    url, title = track.url, track.title
+    trace = PlaybackTrace('play_next', ctx.guild.id)
+    status = StatusMessage(ctx)
+    status.update(f"⏭️ Tocando próxima: **{title}**")
     
-    # Download next song
-    loop = asyncio.get_running_loop()
-    success, mp3_path, error = await loop.run_in_executor(None, download_mp3, url)
+    # Download next song (playback starts while the download is still running)
+    try:
+        with preparing_audio(ctx.guild.id):
+            audio, audio_path, error = await prepare_audio(url, ctx.guild.id, trace, voice_client.channel)
+    except DownloadCancelled:
+        # Skipped by !proximo (go on with the queue) or stopped by !parar (queue is empty now)
+        trace.finish('cancelled')
+        status.update(f"⏹️ Download cancelado: **{title}**")
+        await play_next(ctx)
+        return
     
-    if not success:
-        await ctx.send(f"❌ Erro ao baixar próxima música: {error}")
+    if not audio:
+        trace.finish('error')
+        status.update(f"❌ Erro ao baixar próxima música: **{title}**: {error}", essential=True)
         # Try next song in queue
         await play_next(ctx)
         return
     
-    queue_data['current'] = mp3_path
-    audio = discord.FFmpegPCMAudio(mp3_path, executable=FFMPEG_PATH)
-    
-    def after_play(err):
-        if err:
-            print(f"Playback error: {err}")
-        # Play next song when this one finishes
-        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
-    
-    voice_client.play(audio, after=after_play)
+    if not start_playback(ctx, voice_client, audio, trace):
+        # A !tocar started playing while this song was loading: it plays after that one
+        queue_data['queue'].insert(0, track)
+        trace.finish('queued')
+        return
+    queue_data['current'] = audio_path
     
-    # Show queue status
+    # Show queue status in the same message
     if queue_data['queue']:
-        await ctx.send(f"📋 **{len(queue_data['queue'])}** música(s) na fila")
+        status.update(f"⏭️ Tocando próxima: **{title}**\n📋 **{len(queue_data['queue'])}** música(s) na fila")
+
+
+@tasks.loop(seconds=60)
+async def guild_state_janitor():
+    evicted = evict_idle_guilds()
+    if evicted:
+        print(f"[DEBUG] 🧹 Estado de {evicted} servidor(es) inativo(s) removido ({len(music_queues)} restantes)")
+
+
+@tasks.loop(minutes=MATERIALIZE_INTERVAL_MINUTES or 60)
+async def materialize_pinned_playlists():
+    playlists, error = listar_playlists()
+    if error:
+        print(f"[DEBUG] ❌ {error}")
+        return
+    for pl in playlists or []:
+        if not pl['pinned']:
+            continue
+        songs, error = carregar_playlist(pl['name'])
+        if error:
+            print(f"[DEBUG] ❌ {error}")
+            continue
+        progress = await materialize_playlist(songs)
+        print(f"[DEBUG] 📌 Playlist fixada '{pl['name']}': {format_materialize_counts(progress)}")
 
 
 @bot.event
 async def on_ready():
+    if not guild_state_janitor.is_running():
+        guild_state_janitor.start()
+    if MATERIALIZE_INTERVAL_MINUTES > 0 and not materialize_pinned_playlists.is_running():
+        materialize_pinned_playlists.start()
     print(f"Bot conectado como {bot.user}")
 
 
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # Bot left (or was kicked from) the voice channel: drop downloads, queue and idle timer
+    if member.id == bot.user.id and before.channel and not after.channel:
+        cancel_downloads(member.guild.id)
+        cancel_idle_disconnect(member.guild.id)
+        queue_data = get_queue(member.guild.id)
+        queue_data['queue'].clear()
+        release_current(queue_data)
+        return
+
+    # Everyone left the channel of an idle bot: no reason to keep the connection warm
+    voice_client = member.guild.voice_client
+    if (
+        voice_client is not None
+        and before.channel is not None
+        and before.channel == voice_client.channel
+        and after.channel != before.channel
+        and not voice_client.is_playing()
+        and not voice_client.is_paused()
+        and not any(not m.bot for m in before.channel.members)
+    ):
+        cancel_idle_disconnect(member.guild.id)
+        await voice_client.disconnect()
+
+
 @bot.command(name="ajuda")
 async def ajuda(ctx):
     help_message = (
@@ -577,123 +2173,164 @@ async def ajuda(ctx):
         "**🎼 Playlists:**\n"
         "➕ `!criar_playlist <nome>` - Cria uma playlist\n"
         "📝 `!adicionar_a_playlist <nome> <URL>` - Adiciona música à playlist\n"
+        "📥 `!importar_playlist <nome> <URLs...>` - Adiciona várias músicas (ou uma playlist do YouTube)\n"
         "🎵 `!tocar_playlist <nome>` - Toca uma playlist\n"
         "🗑️ `!apagar_playlist <nome>` - Apaga uma playlist\n"
         "📋 `!playlists` - Lista todas as playlists\n"
         "👁️ `!ver_playlist <nome>` - Mostra músicas da playlist\n\n"
         "**🔧 Admin:**\n"
+        "💾 `!materializar_playlist <nome>` - [ADMIN] Baixa a playlist para o cache\n"
+        "📌 `!fixar_playlist <nome>` - [ADMIN] Mantém a playlist sempre em cache\n"
+        "📍 `!desafixar_playlist <nome>` - [ADMIN] Libera a playlist do cache fixo\n"
+        "📏 `!limites` - Mostra os limites de download do servidor\n"
+        "📐 `!definir_limites <min> <MB> [ao_vivo]` - [ADMIN] Define os limites de download\n"
         "🔧 `!setcookies` - [ADMIN] Atualiza cookies\n"
         "🗑️ `!clearcookies` - [ADMIN] Limpa cookies\n"
-        "📤 `!export_cookies_base64` - [ADMIN] Exporta cookies"
+        "📤 `!export_cookies_base64` - [ADMIN] Exporta cookies\n"
+        "🧠 `!memoria` - [ADMIN] Uso de memória por servidor\n"
+        "📊 `!stats [minutos]` - [ADMIN] Latência até o primeiro áudio (p50/p95/p99)"
     )
     await ctx.send(help_message)
 
 @bot.command(name="continuar")
 async def continuar(ctx):
     if not ctx.voice_client or not ctx.voice_client.is_paused():
-        await ctx.send("Nada está pausado.")
+        await reply(ctx, "Nada está pausado.")
         return
 
     ctx.voice_client.resume()
-    await ctx.send("Continuando.")
+    await reply(ctx, "Continuando.")
 
 @bot.command(name="pausar")
 async def pausar(ctx):
     if not ctx.voice_client or not ctx.voice_client.is_playing():
-        await ctx.send("Nada está tocando.")
+        await reply(ctx, "Nada está tocando.")
         return
 
     ctx.voice_client.pause()
-    await ctx.send("Pausado.")
+    await reply(ctx, "Pausado.")
 
 @bot.command(name="tocar")
 async def tocar(ctx, url: str):
     if not is_valid_youtube_url(url):
-        await ctx.send("❌ URL do YouTube inválida.")
+        await reply(ctx, "❌ URL do YouTube inválida.")
         return
-
-    voice_client = await ensure_voice(ctx)
-    if not voice_client:
+    # Checked up front: otherwise the status message, title fetch and download start for nothing
+    if not ctx.author.voice or not ctx.author.voice.channel:
+        await reply(ctx, "Você precisa estar em um canal de voz.")
         return
-    
+
+    trace = PlaybackTrace('tocar', ctx.guild.id)
     queue_data = get_queue(ctx.guild.id)
-    
-    # Get video info for title
-    await ctx.send("🔍 Obtendo informações...")
-    loop = asyncio.get_running_loop()
-    video_info, error = await loop.run_in_executor(None, get_video_info, url)
-    title = video_info.get('title', 'Sem título') if video_info else 'Sem título'
-    
-    # If already playing, add to queue
-    if voice_client.is_playing() or voice_client.is_paused():
-        queue_data['queue'].append((url, title))
-        position = len(queue_data['queue'])
-        await ctx.send(f"➕ **{title}** adicionada à fila (posição #{position})")
+    status = StatusMessage(ctx)
+
+    def enqueue(title):
+        queue_data['queue'].append(Track(url, title))
+        trace.finish('queued')
+        status.update(f"➕ **{title}** adicionada à fila (posição #{len(queue_data['queue'])})", essential=True)
+
+    # If already playing, only the title is needed to add it to the queue
+    if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+        with trace.span('voice_connect'):
+            voice_client = await ensure_voice(ctx)
+        if not voice_client:
+            return
+        status.update("🔍 Obtendo informações...")
+        video_info, error = await fetch_video_info(url, trace)
+        enqueue(video_info.get('title', 'Sem título') if video_info else 'Sem título')
         return
-    
-    # Not playing, download and play immediately
-    await ctx.send(f"⬇️ Baixando: **{title}**...")
-    success, mp3_path, error = await loop.run_in_executor(None, download_mp3, url)
 
-    if not success:
-        await ctx.send(f"❌ Falha ao baixar: {error}")
-        return
+    # Not playing: join the channel, fetch the title and buffer the audio at the same time
+    status.update("⬇️ Baixando...")
+    started = False
 
-    queue_data['current'] = mp3_path
-    audio = discord.FFmpegPCMAudio(mp3_path, executable=FFMPEG_PATH)
+    async def fetch_title():
+        video_info, error = await fetch_video_info(url, trace)
+        title = video_info.get('title', 'Sem título') if video_info else 'Sem título'
+        if not started:
+            status.update(f"⬇️ Baixando: **{title}**...")
+        return title
 
-    def after_play(err):
-        if err:
-            print(f"Playback error: {err}")
-        # Play next song when this one finishes
-        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+    title_task = asyncio.create_task(fetch_title())
+    try:
+        voice_client, audio, audio_path, error = await connect_and_prepare(ctx, url, trace)
+    except DownloadCancelled:
+        title_task.cancel()
+        trace.finish('cancelled')
+        status.update("⏹️ Download cancelado")
+        return
+    except BaseException:
+        title_task.cancel()
+        raise
+
+    if not audio:
+        title_task.cancel()
+        if error:
+            trace.finish('error')
+            status.update(f"❌ Falha ao baixar: {error}", essential=True)
+        return
 
-    voice_client.play(audio, after=after_play)
-    await ctx.send(f"🎵 Tocando agora: **{title}**")
+    started = start_playback(ctx, voice_client, audio, trace)
+    if started:
+        queue_data['current'] = audio_path
+    title = await title_task
+    if not started:
+        # Another !tocar won the race while this one was buffering
+        enqueue(title)
+        return
+    status.update(f"🎵 Tocando agora: **{title}**", essential=True)
 
 
 @bot.command(name="parar")
 async def parar(ctx):
     if not ctx.voice_client:
-        await ctx.send("❌ Não conectado a um canal de voz.")
+        await reply(ctx, "❌ Não conectado a um canal de voz.")
         return
 
     queue_data = get_queue(ctx.guild.id)
     
-    # Stop playback
+    # Stop playback and kill in-flight downloads
+    cancel_downloads(ctx.guild.id)
     ctx.voice_client.stop()
     
     # Clean up current file
-    if queue_data['current']:
-        cleanup_file(queue_data['current'])
-        queue_data['current'] = None
+    release_current(queue_data)
     
     # Clear queue
     queue_data['queue'].clear()
     
+    cancel_idle_disconnect(ctx.guild.id)
     await ctx.voice_client.disconnect()
-    await ctx.send("⏹️ Parado e desconectado. Fila limpa.")
+    await reply(ctx, "⏹️ Parado e desconectado. Fila limpa.")
 
 
 @bot.command(name="proximo")
 async def proximo(ctx):
     """Skip to next song in queue"""
     if not ctx.voice_client:
-        await ctx.send("❌ Não conectado a um canal de voz.")
+        await reply(ctx, "❌ Não conectado a um canal de voz.")
         return
     
     queue_data = get_queue(ctx.guild.id)
     
     if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
-        await ctx.send("❌ Nada está tocando.")
+        if any(not download.done for download in queue_data['downloads']):
+            # play_next is still downloading: cancelling makes it move on to the next song
+            cancel_downloads(ctx.guild.id)
+            await reply(ctx, "⏭️ Download cancelado, pulando...", essential=False)
+            return
+        await reply(ctx, "❌ Nada está tocando.")
         return
     
+    # The current song may still be downloading; free FFmpeg and bandwidth right away
+    cancel_downloads(ctx.guild.id)
+    
     if not queue_data['queue']:
-        await ctx.send("⏭️ Não há próxima música na fila. Parando...")
+        await reply(ctx, "⏭️ Não há próxima música na fila. Parando...", essential=False)
         ctx.voice_client.stop()
         return
     
-    await ctx.send(f"⏭️ Pulando... ({len(queue_data['queue'])} na fila)")
+    await reply(ctx, f"⏭️ Pulando... ({len(queue_data['queue'])} na fila)", essential=False)
     ctx.voice_client.stop()  # This triggers after_play callback which calls play_next
 
 @bot.command(name="fila")
@@ -702,7 +2339,7 @@ async def fila(ctx):
     queue_data = get_queue(ctx.guild.id)
     
     if not queue_data['queue'] and not queue_data['current']:
-        await ctx.send("📋 A fila está vazia.")
+        await reply(ctx, "📋 A fila está vazia.")
         return
     
     message = "📋 **Fila de Músicas:**\n\n"
@@ -712,15 +2349,15 @@ async def fila(ctx):
     
     if queue_data['queue']:
         message += "\n**Próximas:**\n"
-        for i, (url, title) in enumerate(queue_data['queue'][:10], 1):
-            message += f"{i}. {title}\n"
+        for i, track in enumerate(queue_data['queue'][:10], 1):
+            message += f"{i}. {track.title}\n"
         
         if len(queue_data['queue']) > 10:
             message += f"\n... e mais {len(queue_data['queue']) - 10} música(s)"
     else:
         message += "\n_Nenhuma música na fila_"
     
-    await ctx.send(message)
+    await reply(ctx, message)
 
 @bot.command(name="limpar")
 async def limpar(ctx):
@@ -728,12 +2365,12 @@ async def limpar(ctx):
     queue_data = get_queue(ctx.guild.id)
     
     if not queue_data['queue']:
-        await ctx.send("📋 A fila já está vazia.")
+        await reply(ctx, "📋 A fila já está vazia.")
         return
     
     count = len(queue_data['queue'])
     queue_data['queue'].clear()
-    await ctx.send(f"🗑️ Fila limpa! {count} música(s) removida(s).")
+    await reply(ctx, f"🗑️ Fila limpa! {count} música(s) removida(s).")
 
 
 # ============= PLAYLIST COMMANDS =============
@@ -755,68 +2392,117 @@ async def adicionar_a_playlist_cmd(ctx, playlist_name: str, url: str):
         return
     
     # Get video info for title
-    await ctx.send("🔍 Obtendo informações...")
-    loop = asyncio.get_running_loop()
-    video_info, error = await loop.run_in_executor(None, get_video_info, url)
+    status = StatusMessage(ctx)
+    status.update("🔍 Obtendo informações...")
+    video_info, error = await fetch_video_info(url)
     title = video_info.get('title', 'Sem título') if video_info else 'Sem título'
     
     success, message = adicionar_a_playlist(playlist_name, url, title)
     if success:
-        await ctx.send(f"✅ **{title}** adicionada à playlist **{playlist_name}**! {message}")
+        status.update(f"✅ **{title}** adicionada à playlist **{playlist_name}**! {message}", essential=True)
     else:
-        await ctx.send(f"❌ {message}")
+        status.update(f"❌ {message}", essential=True)
+
+@bot.command(name="importar_playlist")
+async def importar_playlist_cmd(ctx, playlist_name: str, *urls: str):
+    """Add many songs (URLs or a YouTube playlist) to a playlist at once"""
+    if not urls:
+        await reply(ctx, "❌ Uso: `!importar_playlist <nome> <URL> [URL ...]` (aceita links de playlists do YouTube)")
+        return
+    
+    status = StatusMessage(ctx)
+    status.update(f"📥 Importando para **{playlist_name}**...")
+    items, error = await importar_para_playlist(
+        playlist_name, urls, lambda done, total: status.update(f"📥 Importando para **{playlist_name}**: títulos {done}/{total}")
+    )
+    if error:
+        status.update(f"❌ {error}", essential=True)
+        return
+    
+    counts = {key: sum(1 for item in items if item['status'] == key) for key in ('added', 'duplicate', 'invalid', 'error')}
+    message = (
+        f"📥 **{playlist_name}**: {counts['added']} adicionada(s), {counts['duplicate']} repetida(s), "
+        f"{counts['invalid'] + counts['error']} com erro\n"
+    )
+    # Problems first, they are what needs attention
+    icons = {'error': "❌", 'invalid': "⚠️", 'duplicate': "🔁", 'added': "✅"}
+    ordered = sorted(items, key=lambda item: list(icons).index(item['status']))
+    for item in ordered[:15]:
+        line = f"\n{icons[item['status']]} {(item['title'] or item['url'])[:80]}"
+        if item['error']:
+            line += f" - {item['error'][:80]}"
+        message += line
+    if len(items) > 15:
+        message += f"\n... e mais {len(items) - 15} item(ns)"
+    status.update(message, essential=True)
 
 @bot.command(name="tocar_playlist")
 async def tocar_playlist_cmd(ctx, *, playlist_name: str):
     """Load and play a playlist"""
-    voice_client = await ensure_voice(ctx)
-    if not voice_client:
+    if not ctx.author.voice or not ctx.author.voice.channel:
+        await reply(ctx, "Você precisa estar em um canal de voz.")
         return
-    
-    songs, error = carregar_playlist(playlist_name)
+
+    trace = PlaybackTrace('tocar_playlist', ctx.guild.id)
+    with trace.span('metadata'):
+        songs, error = carregar_playlist(playlist_name)
     if error:
-        await ctx.send(f"❌ {error}")
+        await reply(ctx, f"❌ {error}")
         return
     
     if not songs:
-        await ctx.send(f"❌ Playlist **{playlist_name}** está vazia!")
+        await reply(ctx, f"❌ Playlist **{playlist_name}** está vazia!")
         return
     
     queue_data = get_queue(ctx.guild.id)
     
     # If already playing, add all songs to queue
-    if voice_client.is_playing() or voice_client.is_paused():
+    if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+        with trace.span('voice_connect'):
+            voice_client = await ensure_voice(ctx)
+        if not voice_client:
+            return
         for song in songs:
-            queue_data['queue'].append((song['url'], song['title']))
-        await ctx.send(f"➕ Playlist **{playlist_name}** adicionada à fila! ({len(songs)} músicas)")
+            queue_data['queue'].append(Track(song['url'], song['title']))
+        trace.finish('queued')
+        await reply(ctx, f"➕ Playlist **{playlist_name}** adicionada à fila! ({len(songs)} músicas)")
         return
     
     # Not playing, add first song to play now, rest to queue
     first_song = songs[0]
-    await ctx.send(f"🎵 Carregando playlist **{playlist_name}** ({len(songs)} músicas)...")
-    
-    # Add rest to queue
-    for song in songs[1:]:
-        queue_data['queue'].append((song['url'], song['title']))
+    status = StatusMessage(ctx)
+    status.update(f"🎵 Carregando playlist **{playlist_name}** ({len(songs)} músicas)...")
     
-    # Download and play first song
-    loop = asyncio.get_running_loop()
-    success, mp3_path, error = await loop.run_in_executor(None, download_mp3, first_song['url'])
+    # Join the channel and download the first song at the same time
+    try:
+        voice_client, audio, audio_path, error = await connect_and_prepare(ctx, first_song['url'], trace)
+    except DownloadCancelled:
+        trace.finish('cancelled')
+        status.update(f"⏹️ Download cancelado: **{first_song['title']}**")
+        return
     
-    if not success:
-        await ctx.send(f"❌ Falha ao baixar primeira música: {error}")
+    if not audio:
+        if error:
+            trace.finish('error')
+            status.update(f"❌ Falha ao baixar primeira música: {error}", essential=True)
         return
     
-    queue_data['current'] = mp3_path
-    audio = discord.FFmpegPCMAudio(mp3_path, executable=FFMPEG_PATH)
+    started = start_playback(ctx, voice_client, audio, trace)
+    if started:
+        queue_data['current'] = audio_path
+    else:
+        # Another command started playing meanwhile: queue the whole playlist after it
+        queue_data['queue'].append(Track(first_song['url'], first_song['title']))
+        trace.finish('queued')
     
-    def after_play(err):
-        if err:
-            print(f"Playback error: {err}")
-        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+    # Add rest to queue
+    for song in songs[1:]:
+        queue_data['queue'].append(Track(song['url'], song['title']))
     
-    voice_client.play(audio, after=after_play)
-    await ctx.send(f"🎵 Tocando playlist **{playlist_name}**: **{first_song['title']}**\n📋 {len(songs)-1} música(s) na fila")
+    if started:
+        status.update(f"🎵 Tocando playlist **{playlist_name}**: **{first_song['title']}**\n📋 {len(songs)-1} música(s) na fila", essential=True)
+    else:
+        status.update(f"➕ Playlist **{playlist_name}** adicionada à fila! ({len(songs)} músicas)", essential=True)
 
 @bot.command(name="apagar_playlist")
 async def apagar_playlist_cmd(ctx, *, playlist_name: str):
@@ -841,7 +2527,8 @@ async def playlists_cmd(ctx):
     
     message = "📋 **Playlists Disponíveis:**\n\n"
     for pl in playlists:
-        message += f"🎵 **{pl['name']}** - {pl['count']} música(s)\n"
+        pin = " 📌" if pl['pinned'] else ""
+        message += f"🎵 **{pl['name']}** - {pl['count']} música(s){pin}\n"
     
     await ctx.send(message)
 
@@ -867,9 +2554,104 @@ async def ver_playlist_cmd(ctx, *, playlist_name: str):
     
     await ctx.send(message)
 
+def format_materialize_counts(progress):
+    return (
+        f"{progress['downloaded']} baixada(s), {progress['cached']} já em cache, "
+        f"{len(progress['skipped'])} fora do limite do cache fixo, {len(progress['errors'])} erro(s)"
+    )
+
+@bot.command(name="materializar_playlist")
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def materializar_playlist_cmd(ctx, *, playlist_name: str):
+    """
+    Baixa todas as músicas de uma playlist para o cache de áudio, sem tocar.
+    Uso: !materializar_playlist <nome>
+    Apenas o dono do bot ou administradores do servidor podem usar este comando.
+    """
+    songs, error = carregar_playlist(playlist_name)
+    if error:
+        await reply(ctx, f"❌ {error}")
+        return
+    
+    if not songs:
+        await reply(ctx, "❌ Playlist vazia!")
+        return
+    
+    status = StatusMessage(ctx)
+    status.update(f"💾 Materializando **{playlist_name}**: 0/{len(songs)}...", essential=True)
+    progress = await materialize_playlist(songs, lambda p: status.update(
+        f"💾 Materializando **{playlist_name}**: {p['done']}/{p['total']} ({format_materialize_counts(p)})"
+    ))
+    
+    message = f"✅ Playlist **{playlist_name}** materializada: {format_materialize_counts(progress)}"
+    for title, reason in progress['skipped'][:5]:
+        message += f"\n⏭️ {title}: {reason}"
+    if len(progress['skipped']) > 5:
+        message += f"\n... e mais {len(progress['skipped']) - 5} fora do limite"
+    for title, error in progress['errors'][:5]:
+        message += f"\n❌ {title}: {error}"
+    if len(progress['errors']) > 5:
+        message += f"\n... e mais {len(progress['errors']) - 5} erro(s)"
+    status.update(message, essential=True)
+
+@bot.command(name="fixar_playlist")
+@commands.is_owner()
+async def fixar_playlist_cmd(ctx, *, playlist_name: str):
+    """
+    Fixa uma playlist no cache: suas músicas são baixadas periodicamente e não são removidas
+    enquanto couberem em PINNED_CACHE_MAX_MB.
+    Uso: !fixar_playlist <nome>
+    Apenas o dono do bot pode usar este comando.
+    """
+    success, message = fixar_playlist(playlist_name, True)
+    if not success:
+        await reply(ctx, f"❌ {message}")
+        return
+    await reply(ctx, f"📌 {message}! Use `!materializar_playlist {playlist_name}` para baixá-la agora.")
+
+@bot.command(name="desafixar_playlist")
+@commands.is_owner()
+async def desafixar_playlist_cmd(ctx, *, playlist_name: str):
+    """
+    Remove a fixação de uma playlist no cache.
+    Uso: !desafixar_playlist <nome>
+    Apenas o dono do bot pode usar este comando.
+    """
+    success, message = fixar_playlist(playlist_name, False)
+    await reply(ctx, f"📍 {message}." if success else f"❌ {message}")
+
 # ============= END PLAYLIST COMMANDS =============
 
 
+def format_limits(limits):
+    live = "permitidas" if limits['allow_live'] else "bloqueadas"
+    return f"⏱️ Duração máxima: {limits['max_minutes']:g} min\n📦 Tamanho máximo: {limits['max_mb']:g}MB\n🔴 Transmissões ao vivo: {live}"
+
+@bot.command(name="limites")
+async def limites(ctx):
+    """Show this server's download limits"""
+    await reply(ctx, f"📏 **Limites de download deste servidor:**\n{format_limits(get_limits(ctx.guild.id))}")
+
+@bot.command(name="definir_limites")
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def definir_limites(ctx, max_minutos: float, max_mb: float, ao_vivo: str = "nao"):
+    """
+    Define os limites de download do servidor (não podem passar dos limites globais do bot).
+    Uso: !definir_limites <duração máx. em minutos> <tamanho máx. em MB> [ao_vivo: sim/nao]
+    Apenas o dono do bot ou administradores do servidor podem usar este comando.
+    """
+    if max_minutos <= 0 or max_mb <= 0:
+        await reply(ctx, "❌ Os limites devem ser maiores que zero.")
+        return
+    
+    allow_live = ao_vivo.lower() in ("sim", "s", "yes", "true", "1")
+    success, error = set_guild_limits(ctx.guild.id, max_minutos, max_mb, allow_live)
+    if not success:
+        await reply(ctx, f"❌ {error}")
+        return
+    await reply(ctx, f"✅ **Limites atualizados:**\n{format_limits(get_limits(ctx.guild.id))}")
+
+
 @bot.command(name="setcookies")
 @commands.is_owner()
 async def setcookies(ctx, *, cookies: str = None):
@@ -935,6 +2717,89 @@ async def setcookies(ctx, *, cookies: str = None):
         await ctx.send("❌ Use um dos formatos:\n`!setcookies <cookies>` ou anexe um arquivo .txt")
 
 
+@bot.command(name="memoria")
+@commands.is_owner()
+async def memoria(ctx):
+    """
+    Mostra o uso de memória do estado das filas (por servidor e total).
+    Uso: !memoria
+    Apenas o dono do bot pode usar este comando.
+    """
+    seen = set()
+    total = sys.getsizeof(music_queues)
+    footprints = []
+    for guild_id, queue_data in music_queues.items():
+        # Per-guild sizes count shared titles; the total counts them once
+        footprints.append((estimate_queue_footprint(queue_data), guild_id, len(queue_data['queue'])))
+        total += estimate_queue_footprint(queue_data, seen)
+    footprints.sort(reverse=True)
+
+    message = f"🧠 **Memória das filas** ({len(music_queues)} servidor(es))\n\n"
+    for size, guild_id, queued in footprints[:10]:
+        guild = bot.get_guild(guild_id)
+        name = guild.name if guild else guild_id
+        message += f"• **{name}**: {size / 1024:.1f} KB ({queued} música(s))\n"
+    if len(footprints) > 10:
+        message += f"... e mais {len(footprints) - 10} servidor(es)\n"
+
+    message += f"\n📦 Total das filas: **{total / 1024:.1f} KB**"
+    message += f"\n⬇️ Downloads em andamento: {len(progressive_downloads)}"
+    message += f"\n📨 Mensagens pendentes: {outbound.pending}"
+    if resource is not None:
+        # ru_maxrss is in KB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        message += f"\n🖥️ Pico de memória do processo: **{peak_rss / 1024:.1f} MB**"
+    message += f"\n⏱️ Servidores inativos são removidos após {GUILD_IDLE_TTL:.0f}s"
+
+    await reply(ctx, message)
+
+
+@bot.command(name="stats")
+@commands.is_owner()
+async def stats(ctx, minutes: float = TRACE_WINDOW_MINUTES):
+    """
+    Mostra p50/p95/p99 de cada fase até o primeiro áudio na janela recente.
+    Uso: !stats [minutos]
+    Apenas o dono do bot pode usar este comando.
+    """
+    loop = asyncio.get_running_loop()
+    records = await loop.run_in_executor(None, load_trace_records, time.time() - minutes * 60)
+    if not records:
+        await reply(ctx, f"📊 Nenhum trace nos últimos {minutes:g} minuto(s).")
+        return
+
+    def row(label, values):
+        values_ms = [value * 1000 for value in values]
+        return (
+            f"{label:<22}{len(values_ms):>6}{percentile(values_ms, 50):>9.0f}"
+            f"{percentile(values_ms, 95):>9.0f}{percentile(values_ms, 99):>9.0f}\n"
+        )
+
+    table = f"{'fase (ms)':<22}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}\n"
+    for phase in TRACE_PHASES:
+        values = [r['spans'][phase] for r in records if phase in r.get('spans', {})]
+        if values:
+            table += row(phase, values)
+    for command in ('tocar', 'tocar_playlist', 'play_next'):
+        values = [r['total'] for r in records if r.get('command') == command and r.get('outcome') == 'played']
+        if values:
+            table += row(f"total:{command}", values)
+
+    outcomes = {}
+    for record in records:
+        outcomes[record.get('outcome')] = outcomes.get(record.get('outcome'), 0) + 1
+    summary = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(outcomes.items(), key=str))
+
+    # Each warm reuse skipped a handshake that costs about as much as an average cold connect
+    cold = voice_stats['cold_connects']
+    average_connect = voice_stats['cold_seconds'] / cold if cold else 0.0
+    summary += (
+        f"\n🔌 Voz (desde o início): {cold} conexão(ões) nova(s), média {average_connect * 1000:.0f} ms; "
+        f"{voice_stats['warm_reuses']} reutilizada(s) → ~{voice_stats['warm_reuses'] * average_connect:.1f}s economizados"
+    )
+    await reply(ctx, f"📊 **Tempo até o primeiro áudio** (últimos {minutes:g} min, {len(records)} comandos)\n```\n{table}```{summary}")
+
+
 @bot.command(name="export_cookies_base64")
 @commands.is_owner()
 async def export_cookies_base64(ctx):
@@ -983,13 +2848,31 @@ async def clearcookies(ctx):
     except Exception as e:
         await ctx.send(f"❌ Erro ao limpar cookies: {str(e)}")
     
-def run_flask():
-    app.run(host="0.0.0.0", port=5000, debug=False)
+app.add_routes(routes)
+
+async def start_http_server():
+    """Serve the HTTP API on the running (bot) event loop"""
+    # handler_cancellation: a client disconnect cancels its handler (and with it the download)
+    runner = web.AppRunner(app, access_log=None, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, HTTP_HOST, HTTP_PORT, backlog=1024)
+    await site.start()
+    print(f"[DEBUG] 🌐 API HTTP em http://{HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+
+@bot.event
+async def setup_hook():
+    setup_tracing()
+    # One executor for yt-dlp/file work of both the bot and the HTTP API
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+    )
+    await start_http_server()
 
 
 if __name__ == '__main__':
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    cleanup_partial_cache()
 
     if not DISCORD_TOKEN:
         raise RuntimeError("DISCORD_TOKEN is not set.")